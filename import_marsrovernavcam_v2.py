@@ -6,9 +6,18 @@ import math
 import mathutils
 from mathutils import Vector, Quaternion
 import struct
-import bmesh
-from urllib import request
+import zlib
+import shutil
+import numpy as np
+from urllib import request, error
+import sqlite3
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import json
+from email.utils import formatdate
 import time
+import tempfile
 import re
 from datetime import datetime
 
@@ -37,19 +46,122 @@ nasaimg_path = 'https://mars.nasa.gov/'
 # https://pds-imaging.jpl.nasa.gov/data/mer2-m-navcam-5-xyz-ops-v1.0/mer2no_0xxx/data/
 # https://pds-imaging.jpl.nasa.gov/data/mer/mer2no_0xxx/data/
 
-roverDataDir = []
-roverImageDir = []
-local_data_dir = []
-local_file = []
-
-popup_error = None
-curve_minval = None
-curve_maxval = None
-
 SPIRIT = 1
 OPPORTUNITY = 2
 CURIOSITY = 3
 
+# memory (in MB) a product may use while it is decoded and meshed, see block_rows_for_limit()
+DEFAULT_MEMORY_LIMIT = 512
+
+# products fetched and decoded in parallel, see pipeline_products()
+DEFAULT_WORKERS = 4
+
+# when imported textures are packed into the blend file, see load_texture_material()
+PACK_MODES = [('NOW', "On Import", "Pack every texture as soon as it is loaded"),
+              ('END', "After Import", "Pack all textures of the batch once the import is done"),
+              ('SAVE', "On Save", "Keep the textures external until the blend file is saved"),
+              ('EXTERNAL', "Never", "Reference the textures in the cache directory")]
+
+# longest quad edge allowed per unit of distance from the camera, see build_grid_faces()
+DEFAULT_MAX_STRETCH = 0.1
+
+
+class ImportJob:
+    """Settings and shared state of one import run. The fetch and decode stages only read what is
+    passed in through the job and its products, so jobs can run side by side on threads."""
+
+    def __init__(self, data_dir, fill=True, rad=False, memory_limit=DEFAULT_MEMORY_LIMIT, merge=False,
+                 weld_distance=0.005, catalog=False, prefetch=True, revalidate_days=30, workers=DEFAULT_WORKERS,
+                 max_stretch=DEFAULT_MAX_STRETCH, max_range=0.0, detail_range=0.0, triangulate=False,
+                 mode='MESH', dem_cell=0.1, dem_reduce='MAX', udim=False, pack='NOW', pack_scale=1.0,
+                 proxy_level=0, crop=False, stretch=True, stretch_clip=0.5, stretch_gamma=1.0,
+                 shading=False, smooth=False, asset_cache=False, update=True):
+        self.data_dir = data_dir
+        self.fill = fill
+        self.max_stretch = max_stretch
+        self.max_range = max_range
+        self.detail_range = detail_range
+        self.triangulate = triangulate
+        # 'MESH', 'POINTS' for vertex-only point clouds or 'DEM' for top-down height grids
+        self.mode = mode
+        # DEM cell size in meters, and how the heights of a cell are combined: 'MAX' or 'MEAN'
+        self.dem_cell = dem_cell
+        self.dem_reduce = dem_reduce
+        # share one UDIM texture and material between the meshes of a site
+        self.udim = udim
+        # texture packing policy, see PACK_MODES, and the scale of the packed copies
+        self.pack = pack
+        self.pack_scale = pack_scale
+        # viewport textures are downsampled by 2 ** proxy_level, renders use the full texture
+        self.proxy_level = proxy_level
+        # crop textures to the part of the image with xyz data
+        self.crop = crop
+        # contrast stretch of RAD textures: percent clipped at both ends, and display gamma
+        self.stretch = stretch
+        self.stretch_clip = stretch_clip
+        self.stretch_gamma = stretch_gamma
+        # bake ambient occlusion, slope and normal color attributes, see grid_occlusion()
+        self.shading = shading
+        # smooth shading with custom normals computed from the xyz grid, see grid_normals()
+        self.smooth = smooth
+        # write finished products to per product .blend files and append them on later imports,
+        # see product_asset_path()
+        self.asset_cache = asset_cache
+        # reuse the objects of products imported before instead of adding duplicates, see find_product_object()
+        self.update = update
+        self.rad = rad
+        self.memory_limit = memory_limit
+        self.merge = merge
+        self.weld_distance = weld_distance
+        self.prefetch = prefetch
+        self.revalidate_interval = revalidate_days * 24 * 3600
+        self.workers = workers
+
+        self.catalog = open_catalog(data_dir) if catalog else None
+        self.catalog_lock = threading.Lock()
+
+        # (image id, error code) of every image that failed, see ERROR_MESSAGES
+        self.errors = []
+        self.products = []
+        self.objects = []
+
+
+class ProductRequest:
+    """One image of an import job: where its products are found and what is learned about it"""
+
+    def __init__(self, id, rover, camera, data_dir, image_dir):
+        self.id = id
+        self.rover = rover
+        self.camera = camera
+        self.data_dir = data_dir
+        self.image_dir = image_dir
+
+        self.sol = None
+        # (local, remote) filenames
+        self.xyz = None
+        self.rad = None
+        self.textures = []
+
+        # position in the batch, stored with every point in point cloud mode
+        self.index = None
+        self.plan = None
+        # range of the texture values, for the curves node of the material
+        self.curve = (0.0, 1.0)
+
+        # 'pending', 'imported', 'unchanged' (already in the scene with the same settings)
+        # or 'failed' (with the code of ERROR_MESSAGES in error)
+        self.status = 'pending'
+        self.error = None
+        # seconds spent per stage: 'depth', 'texture' and 'build'
+        self.timings = {}
+        # the mesh object, or the site mosaic the image was merged into; before the build the
+        # object of an earlier import that gets its mesh replaced
+        self.object = None
+
+    def fail(self, code):
+        self.status = 'failed'
+        self.error = code
+
 
 class NavcamDialogOperator(bpy.types.Operator):
     bl_idname = "io.navcamdialog_operator"
@@ -59,9 +171,56 @@ class NavcamDialogOperator(bpy.types.Operator):
     fillhole_bool: bpy.props.BoolProperty(name="Fill Gaps (draft)", default = True)
     #filllength_float: bpy.props.FloatProperty(name="Max Fill Length", min=0.001, max=100.0, default=0.6)
     radimage_bool: bpy.props.BoolProperty(name="Use 16bit RAD texture", default = False)
+    memory_limit_int: bpy.props.IntProperty(name="Memory Limit (MB)", min=64, max=65536, default=DEFAULT_MEMORY_LIMIT)
+    merge_bool: bpy.props.BoolProperty(name="Merge Site Mosaic", default = False)
+    weld_float: bpy.props.FloatProperty(name="Weld Distance", min=0.0001, max=1.0, default=0.005)
+    catalog_bool: bpy.props.BoolProperty(name="Use Volume Catalog", default = False)
+    prefetch_bool: bpy.props.BoolProperty(name="Plan Batch from Labels", default = True)
+    revalidate_int: bpy.props.IntProperty(name="Revalidate Cache (days, 0 = never)", min=0, max=3650, default=30)
+    workers_int: bpy.props.IntProperty(name="Parallel Products", min=1, max=16, default=DEFAULT_WORKERS)
+    cull_stretch_float: bpy.props.FloatProperty(name="Cull Stretched Faces (0 = off)", min=0.0, max=10.0, default=DEFAULT_MAX_STRETCH)
+    max_range_float: bpy.props.FloatProperty(name="Max Range (m, 0 = off)", min=0.0, max=10000.0, default=0.0)
+    detail_range_float: bpy.props.FloatProperty(name="Full Detail Range (m, 0 = off)", min=0.0, max=10000.0, default=0.0)
+    triangulate_bool: bpy.props.BoolProperty(name="Triangulate (shorter diagonal)", default = False)
+    mode_enum: bpy.props.EnumProperty(name="Import As", default='MESH',
+                                      items=[('MESH', "Mesh", "Textured mesh of the depth image"),
+                                             ('POINTS', "Point Cloud", "Vertices only, with intensity, range and image attributes"),
+                                             ('DEM', "Height Grid (DEM)", "Regular top-down height grid binned from the xyz points")])
+    dem_cell_float: bpy.props.FloatProperty(name="DEM Cell Size (m)", min=0.01, max=100.0, default=0.1)
+    dem_reduce_enum: bpy.props.EnumProperty(name="DEM Cell Height", default='MAX',
+                                            items=[('MAX', "Max", "Highest point of the cell"),
+                                                   ('MEAN', "Mean", "Mean height of the points of the cell")])
+    udim_bool: bpy.props.BoolProperty(name="One UDIM Texture per Site", default = False)
+    pack_enum: bpy.props.EnumProperty(name="Pack Textures", default='NOW', items=PACK_MODES)
+    pack_scale_float: bpy.props.FloatProperty(name="Packed Texture Scale", min=0.05, max=1.0, default=1.0)
+    proxy_enum: bpy.props.EnumProperty(name="Viewport Texture", default='0',
+                                       items=[('0', "Full", "Use the full texture in the viewport"),
+                                              ('1', "1/2", "Half size proxy in the viewport, full texture for renders"),
+                                              ('2', "1/4", "Quarter size proxy in the viewport, full texture for renders"),
+                                              ('3', "1/8", "Eighth size proxy in the viewport, full texture for renders")])
+    crop_bool: bpy.props.BoolProperty(name="Crop Textures to Depth Data", default = False)
+    stretch_bool: bpy.props.BoolProperty(name="Stretch RAD Contrast", default = True)
+    stretch_clip_float: bpy.props.FloatProperty(name="Stretch Clip (%)", min=0.0, max=20.0, default=0.5)
+    stretch_gamma_float: bpy.props.FloatProperty(name="Stretch Gamma", min=0.1, max=5.0, default=1.0)
+    shading_bool: bpy.props.BoolProperty(name="Bake AO and Slope Attributes", default = False)
+    smooth_bool: bpy.props.BoolProperty(name="Smooth Grid Normals", default = False)
+    asset_cache_bool: bpy.props.BoolProperty(name="Cache Products as .blend", default = False)
+    update_bool: bpy.props.BoolProperty(name="Update Existing Objects", default = True)
 
     def execute(self, context):
-        ReadNavcamString(self.navcam_string, self.fillhole_bool, self.radimage_bool)
+        # the dialog values as keyword arguments of ImportJob
+        ReadNavcamString(self.navcam_string, fill=self.fillhole_bool, rad=self.radimage_bool,
+                         memory_limit=self.memory_limit_int, merge=self.merge_bool, weld_distance=self.weld_float,
+                         catalog=self.catalog_bool, prefetch=self.prefetch_bool,
+                         revalidate_days=self.revalidate_int, workers=self.workers_int,
+                         max_stretch=self.cull_stretch_float, max_range=self.max_range_float,
+                         detail_range=self.detail_range_float, triangulate=self.triangulate_bool,
+                         mode=self.mode_enum, dem_cell=self.dem_cell_float, dem_reduce=self.dem_reduce_enum,
+                         udim=self.udim_bool, pack=self.pack_enum, pack_scale=self.pack_scale_float,
+                         proxy_level=int(self.proxy_enum), crop=self.crop_bool, stretch=self.stretch_bool,
+                         stretch_clip=self.stretch_clip_float, stretch_gamma=self.stretch_gamma_float,
+                         shading=self.shading_bool, smooth=self.smooth_bool, asset_cache=self.asset_cache_bool,
+                         update=self.update_bool)
         return {'FINISHED'}
 
     def invoke(self, context, event):
@@ -69,140 +228,247 @@ class NavcamDialogOperator(bpy.types.Operator):
         return wm.invoke_props_dialog(self, width=550)
 
 
-def ReadNavcamString(inString, inFillBool, inRadBool):
-    global local_data_dir, roverDataDir, roverImageDir, popup_error, curve_minval, curve_maxval
-
+def ReadNavcamString(inString, **settings):
+    # settings: keyword arguments of ImportJob
     if inString=="": return
     print ('------------inString=',inString)
 
     time_start = time.time()
 
     SetRenderSettings()
-    local_data_dir = os.path.join(bpy.context.preferences.filepaths.temporary_directory, 'MarsRoverImages/')
-
-    collString = inString.split(",")
-    for i in range(0, len(collString)):
-        if(len(collString[i]) == 0): collString.pop(i)
+    data_dir = os.path.join(bpy.context.preferences.filepaths.temporary_directory, 'MarsRoverImages/')
 
-    for i in range(0, len(collString)):
-        theString = os.path.splitext(collString[i].strip( ' ' ))[0].upper() # case insensitive
+    job = ImportJob(data_dir, **settings)
 
-        if len(theString) == 27 or len(theString) == 36:
-            pass
-        else:
-            popup_error = 3
-            bpy.context.window_manager.popup_menu(draw, title="Name Error", icon='ERROR')
-            return
+    run_import_job(job, inString.split(","))
 
-        rover = None
-        roverCamera = None
-
-        print('-----------Processing input ',   theString);
-        if theString.startswith( 'N' ):
-            rover = CURIOSITY
-            
-            
-        if theString.startswith( '2N' ) :
-            rover = SPIRIT
-            roverCamera == 'navcam'
-            roverDataDir = 'mer/mer2no_0xxx/data/'  
-            roverImageDir = 'mer/gallery/all/2/n/'  
-            print ('Detected image from navcam')
-        if theString.startswith( '2P' ) :
-            rover = SPIRIT
-            roverCamera == 'pancam'
-            roverDataDir = 'mer/mer2po_0xxx/data/'  
-            roverImageDir = 'mer/gallery/all/2/p/'  
-            print ('Detected image from PANCAM')
-        if theString.startswith( '2F' ) :
-            rover = SPIRIT
-            roverCamera == 'fhazcam'
-            roverDataDir = 'mer/mer2ho_0xxx/data/'  
-            roverImageDir = 'mer/gallery/all/2/h/'  
-            print ('Detected image from FRONT HAZCAM')
-        if theString.startswith( '2R' ) :
-            rover = SPIRIT
-            roverCamera == 'rhazcam'
-            roverDataDir = 'mer/mer2ho_0xxx/data/'  
-            roverImageDir = 'mer/gallery/all/2/h/'  
-            print ('Detected image from REAR HAZCAM')
-            
-            
-        if theString.startswith( '1N' ) :
-            rover = OPPORTUNITY
-            roverCamera == 'navcam'
-            roverDataDir = 'mer/mer1no_0xxx/data/'  
-            roverImageDir = 'mer/gallery/all/1/n/'  
-            print ('Detected image from navcam')
-        if theString.startswith( '1P' ) :
-            rover = OPPORTUNITY
-            roverCamera == 'pancam'
-            roverDataDir = 'mer/mer1po_0xxx/data/'  
-            roverImageDir = 'mer/gallery/all/1/p/'  
-            print ('Detected image from PANCAM')
-        if theString.startswith( '1F' ) :
-            rover = OPPORTUNITY
-            roverCamera == 'fhazcam'
-            roverDataDir = 'mer/mer1ho_0xxx/data/'  
-            roverImageDir = 'mer/gallery/all/1/h/'  
-            print ('Detected image from FRONT HAZCAM')
-        if theString.startswith( '1R' ) :
-            rover = OPPORTUNITY
-            roverCamera == 'rhazcam'
-            roverDataDir = 'mer/mer1ho_0xxx/data/'  
-            roverImageDir = 'mer/gallery/all/1/h/'  
-            print ('Detected image from REAR HAZCAM')
-            
-            
-        if rover == None:
-            popup_error = 4
-            bpy.context.window_manager.popup_menu(draw, title="Name Error", icon='ERROR')
-            return
+    if job.errors:
+        code = job.errors[0][1]
+        show_error(code, "Name Error" if code in (3, 4) else "URL Error")
 
-        sol_ref = tosol(rover, theString)
+    elapsed = float(time.time() - time_start)
+    print("Script execution time: %s" % time.strftime('%H:%M:%S', time.gmtime(elapsed)))
 
-        print ('----------Assigned:  rover=',rover, SPIRIT, OPPORTUNITY, CURIOSITY)
-        print ('----------Assigned:  sol_ref=',sol_ref)
 
+class NavcamImportError(Exception):
+    """Raised by import_navcam(). errors holds (image id, error code) for every failed image,
+    see ERROR_MESSAGES; job is the ImportJob with the status of every image."""
+
+    def __init__(self, errors, job=None):
+        self.errors = errors
+        self.job = job
+        Exception.__init__(self, '; '.join('%s: %s' %(image_id, ERROR_MESSAGES[code]) for image_id, code in errors))
+
+
+def import_navcam(ids, data_dir=None, strict=False, **settings):
+    # Scripting entry point, usable with blender --background. ids is a list of image ids (or one
+    # comma separated string), settings are keyword arguments of ImportJob, e.g. fill=False or
+    # workers=4. Returns the ImportJob: job.objects holds the created objects and
+    # job.products the status, error code and stage timings of every image.
+    # Raises NavcamImportError when an id is malformed, when no image could be imported, or with
+    # strict=True when any image failed.
+    if isinstance(ids, str):
+        ids = ids.split(',')
+    if data_dir is None:
+        data_dir = os.path.join(bpy.context.preferences.filepaths.temporary_directory, 'MarsRoverImages/')
+
+    job = ImportJob(data_dir, **settings)
+
+    run_import_job(job, ids)
+
+    if job.errors and (strict or not job.objects or any(code in (3, 4) for image_id, code in job.errors)):
+        raise NavcamImportError(job.errors, job)
+    return job
+
+
+def run_import_job(job, ids):
+    # Import a batch of image ids with the settings of job. Failures are collected in job.errors
+    # as (image id, error code). Returns the created mesh objects, also kept in job.objects.
+    load_mirror_stats(job.data_dir)
+    start_mirror_probe()
+
+    products, errors = resolve_products(ids, job.data_dir)
+    job.products = products
+    for index, product in enumerate(products):
+        product.index = index
+
+    if errors:
+        job.errors.extend(errors)
+        return []
+
+    if job.catalog is not None:
+        # volume root of the data directory, e.g. msl/MSLNAV_1XXX/
+        for volume in set(p.data_dir.rstrip('/').rsplit('/', 1)[0] + '/' for p in products):
+            with job.catalog_lock:
+                refresh_catalog_volume(job.catalog, job.data_dir, volume)
+
+    # only standalone meshes are cached and updated per product, mosaics and tiles depend on the whole batch
+    standalone = job.mode == 'MESH' and not job.merge and not job.udim
+    use_asset_cache = job.asset_cache and standalone
+    settings = product_settings_key(job)
+    texture = texture_settings_key(job)
+    if standalone and (job.update or job.asset_cache):
+        pending = []
+        for product in products:
+            time_start = time.time()
+            if job.update:
+                product.object = find_product_object(product.id)
+                if product.object is not None and product.object.get('navcam_settings') == settings:
+                    print('Already in the scene with the same settings, skipping ', product.id)
+                    product.status = 'unchanged'
+                    job.objects.append(product.object)
+                    continue
+            if use_asset_cache and product.object is None:
+                product.object = load_product_asset(product_asset_path(job, product),
+                                                    get_collection('Sol%s' %(product.sol)))
+                if product.object is not None:
+                    product.status = 'imported'
+                    product.timings['build'] = time.time() - time_start
+                    job.objects.append(product.object)
+                    continue
+            # built below, in place of product.object when there is one
+            pending.append(product)
+        products = pending
+        if len(products) == 0:
+            return job.objects
+
+    if job.prefetch:
+        products, missing = plan_batch(job, products)
+        for product in missing:
+            product.fail(2)
+            job.errors.append((product.id, 2))
+        if len(products) == 0:
+            return []
+
+    # products per site, only filled when merging into site mosaics
+    sites = {}
+    site_products = {}
+    # (product, depth, texture) per site, built once all textures of the site are known
+    udim_sites = {}
+    objects = job.objects
+
+    for i, (product, depth, image_texture_filename) in enumerate(pipeline_products(job, products)):
+        theString = product.id
+        rover = product.rover
+        sol_ref = product.sol
+
+        print( '\nConstructing mesh %d/%d, sol %d, name %s' %( i + 1, len(products), sol_ref, theString) )
 
-        if rover == CURIOSITY:
-            if sol_ref < 1870:
-                roverDataDir = 'msl/MSLNAV_1XXX/DATA_V1/'
-                roverImageDir = 'msl/MSLNAV_1XXX/EXTRAS_V1/FULL/'
+        if (image_texture_filename == None):
+            print('Unable to retrieve texture image for ', theString)
+            product.fail(1)
+            job.errors.append((theString, 1))
+            continue
+
+        if (depth == None):
+            print('Unable to retrieve depth image for ', theString)
+            product.fail(2)
+            job.errors.append((theString, 2))
+            continue
+
+        time_start = time.time()
+        product.status = 'imported'
+
+        if job.mode in ('POINTS', 'DEM'):
+            entry = (depth, point_attributes(product, depth, image_texture_filename))
+            if not job.merge:
+                name = '%s-%s' %(sol_ref, depth['name'])
+                if job.mode == 'DEM':
+                    product.object = build_dem(name + '-DEM', get_collection('Sol%s' %(sol_ref)), [entry], job)
+                else:
+                    product.object = build_point_cloud(name, get_collection('Sol%s' %(sol_ref)), [entry])
+                objects.append(product.object)
             else:
-                roverDataDir = 'msl/MSLNAV_1XXX/DATA/'
-                roverImageDir = 'msl/MSLNAV_1XXX/EXTRAS/FULL/'
-
-        print ('----------Assigned:  roverDataDir=',roverDataDir)
-        print ('----------Assigned:  roverImageDir=',roverImageDir)
-
-
-        print( '\nConstructing mesh %d/%d, sol %d, name %s' %( i + 1, len(collString), sol_ref, theString) )
-
-        curve_minval = 0.0
-        curve_maxval = 1.0
-
-        if inRadBool:
-            image_16bit_texture_filename = get_16bit_texture_image(rover, sol_ref, theString, roverImageDir)
-            image_texture_filename = convert_to_png(image_16bit_texture_filename)
+                site = product_site(rover, sol_ref, depth['label'])
+                sites.setdefault((rover, site), []).append(entry)
+                site_products.setdefault((rover, site), []).append(product)
+            product.timings['build'] = time.time() - time_start
+            continue
+
+        if job.crop:
+            label = depth['label']
+            image_texture_filename, depth['crop'] = crop_texture(image_texture_filename, depth['grid_index'],
+                                                                 label['LINES'], label['LINE_SAMPLES'])
+
+        if job.udim:
+            site = product_site(rover, sol_ref, depth['label'])
+            udim_sites.setdefault((rover, site), []).append((product, depth, image_texture_filename))
+            continue
+
+        # the texture file is part of the key: with crop, fill and range settings change the crop box
+        texture_key = '%s:%s' %(texture, os.path.basename(image_texture_filename))
+        if product.object is not None and product.object.get('navcam_texture') == texture_key \
+                and product.object.active_material is not None:
+            # updating in place with the same texture: keep the material and its images
+            material = product.object.active_material
         else:
-            image_texture_filename = get_texture_image(rover, sol_ref, theString)
+            material = load_texture_material(image_texture_filename, product.curve, job.pack, job.pack_scale,
+                                             job.proxy_level, job.shading)
+
+        if not job.merge:
+            product.object = build_depth_mesh(rover, sol_ref, depth, image_texture_filename, product.curve, material,
+                                              target=product.object)
+            product.object['navcam_id'] = product.id
+            product.object['navcam_settings'] = settings
+            product.object['navcam_texture'] = texture_key
+            objects.append(product.object)
+            if use_asset_cache:
+                write_product_asset(product_asset_path(job, product), [product.object, product_camera(product.object)])
+            product.timings['build'] = time.time() - time_start
+            continue
+
+        site = product_site(rover, sol_ref, depth['label'])
+        sites.setdefault((rover, site), []).append((sol_ref, depth, material, (0.0, 0.0)))
+        site_products.setdefault((rover, site), []).append(product)
+
+        add_camera_and_caption(rover, sol_ref, depth, image_texture_filename, get_collection('Sol%s' %(sol_ref)), product_center(depth))
+        product.timings['build'] = time.time() - time_start
 
-        if (image_texture_filename == None):
-            popup_error = 1
-            bpy.context.window_manager.popup_menu(draw, title="URL Error", icon='ERROR')
-            return
+    trover = [ 'Spirit', 'Opportunity', 'Curiosity' ]
+    for (rover, site), ready in udim_sites.items():
+        # one curve for the shared material: the range covering every product of the site
+        curve = (min(product.curve[0] for product, depth, texture in ready),
+                 max(product.curve[1] for product, depth, texture in ready))
+        material = load_udim_material('%s-%s' %(trover[rover-1], site), [texture for product, depth, texture in ready],
+                                      curve, job.data_dir, job.pack, job.shading)
+
+        for tile, (product, depth, image_texture_filename) in enumerate(ready):
+            time_start = time.time()
+            if material is not None:
+                tile_material, uv_offset = material, udim_offset(tile)
+            else:
+                tile_material = load_texture_material(image_texture_filename, product.curve, job.pack, job.pack_scale,
+                                                      job.proxy_level, job.shading)
+                uv_offset = (0.0, 0.0)
+
+            if not job.merge:
+                product.object = build_depth_mesh(rover, product.sol, depth, image_texture_filename, product.curve,
+                                                  tile_material, uv_offset)
+                objects.append(product.object)
+            else:
+                sites.setdefault((rover, site), []).append((product.sol, depth, tile_material, uv_offset))
+                site_products.setdefault((rover, site), []).append(product)
+                add_camera_and_caption(rover, product.sol, depth, image_texture_filename,
+                                       get_collection('Sol%s' %(product.sol)), product_center(depth))
+            product.timings['build'] = time.time() - time_start
+
+    for (rover, site), entries in sites.items():
+        if job.mode == 'DEM':
+            mosaic = build_dem('%s-%s-DEM' %(trover[rover-1], site), get_collection(site), entries, job)
+        elif job.mode == 'POINTS':
+            mosaic = build_point_cloud('%s-%s' %(trover[rover-1], site), get_collection(site), entries)
+        else:
+            mosaic = create_site_mosaic(rover, site, entries, job.weld_distance)
+        objects.append(mosaic)
+        for product in site_products[(rover, site)]:
+            product.object = mosaic
 
-        image_depth_filename = get_depth_image(rover, sol_ref, theString)
-        if (image_depth_filename == None):
-            popup_error = 2
-            bpy.context.window_manager.popup_menu(draw, title="URL Error", icon='ERROR')
-            return
+    if job.pack == 'END':
+        pack_navcam_images('END')
 
-        create_mesh_from_depthimage(rover, sol_ref, image_depth_filename, image_texture_filename, inFillBool, inRadBool)
+    save_mirror_stats(job.data_dir)
 
-    elapsed = float(time.time() - time_start)
-    print("Script execution time: %s" % time.strftime('%H:%M:%S', time.gmtime(elapsed)))
+    return objects
 
 
 def SetRenderSettings():
@@ -218,37 +484,295 @@ def SetRenderSettings():
     backNode.inputs[0].default_value = (0.02, 0.02, 0.02, 1)
 
 
-def download_file(url):
-    global localfile
+def fetch_to_file(url, target, headers={}, timeout=None, keep=(200,)):
+    # Request url with extra headers. The body is only written to target on a response with a
+    # status in keep, so a failed or partial transfer never replaces a cached product.
+    # timeout: seconds the transfer may stall before giving up, None to wait as long as the server
+    # keeps the connection.
+    # Returns the status code and the response headers.
     proper_url = url.replace('\\','/')
+    partfile = target + '.part'
 
     if sys.platform == 'darwin':
-        try:
-            out = subprocess.check_output(['curl', '-I', proper_url])
-
-            if out.decode().find('200 OK') > 0:
-                subprocess.call(['curl', '-o', localfile, '-L', proper_url])
-                return True
-            else:
-                print('Fail to reach a server.\n\n{}'.format(out.decode()))
-                return False
+        cmd = ['curl', '-s', '-L', '-D', '-', '-o', partfile, '-w', '\n%{http_code}']
+        if timeout is not None:
+            cmd = cmd + ['--connect-timeout', str(timeout), '--speed-time', str(timeout), '--speed-limit', '1']
+        for key, value in headers.items():
+            cmd = cmd + ['-H', '%s: %s' %(key, value)]
 
+        try:
+            out = subprocess.check_output(cmd + [proper_url]).decode(errors='replace')
         except subprocess.CalledProcessError as e:
             print('Subprocess failed:\nReturncode: {}\n\nOutput:{}'.format(e.returncode, e.output))
-            return False
+            return None, {}
+
+        status = int(out.strip().splitlines()[-1])
+        # headers of the last response, after redirects
+        response = {}
+        for line in out.strip().splitlines()[:-1]:
+            if line.startswith('HTTP/'):
+                response = {}
+            elif ':' in line:
+                key, value = line.split(':', 1)
+                response[key.strip().lower()] = value.strip()
 
     else:
         try:
-            page = request.urlopen(proper_url)
+            if timeout is not None:
+                page = request.urlopen(request.Request(proper_url, headers=headers), timeout=timeout)
+            else:
+                page = request.urlopen(request.Request(proper_url, headers=headers))
+        except error.HTTPError as e:
+            return e.code, dict((key.lower(), value) for key, value in e.headers.items())
+        except Exception as e:
+            print('Fail to reach a server: {}'.format(e))
+            return None, {}
+
+        status = page.getcode()
+        response = dict((key.lower(), value) for key, value in page.headers.items())
+
+        if status in keep:
+            with open(partfile, 'wb') as f:
+                while True:
+                    chunk = page.read(1 << 20)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+        page.close()
+
+    if status in keep and os.path.isfile(partfile):
+        os.replace(partfile, target)
+    elif os.path.isfile(partfile):
+        os.remove(partfile)
+
+    return status, response
+
+
+# -----------------------------------------------------------------------------
+# Archive mirrors, ranked by measured latency and throughput
+
+# mirror base url: directories laid out differently from pdsimg_path, None for the same layout.
+# A mirror with a layout map only serves the directories listed in it.
+ARCHIVE_MIRRORS = {
+    pdsimg_path: None,
+    'https://pdsimage2.wr.usgs.gov/data/': {
+        'mer/mer1no_0xxx/': 'mer1no/mer1no_0xxx/',
+        'mer/mer1po_0xxx/': 'mer1po/mer1po_0xxx/',
+        'mer/mer1ho_0xxx/': 'mer1ho/mer1ho_0xxx/',
+        'mer/mer2no_0xxx/': 'mer2no/mer2no_0xxx/',
+        'mer/mer2po_0xxx/': 'mer2po/mer2po_0xxx/',
+        'mer/mer2ho_0xxx/': 'mer2ho/mer2ho_0xxx/',
+    },
+}
+
+MIRROR_STATS_NAME = 'mirrors.json'
+MIRROR_RETRIES = 3
+MIRROR_BACKOFF = 2.0  # seconds before the first retry round, doubled for every next round
+MIRROR_MAX_FAILURES = 3  # consecutive failures before a mirror is ranked last
+MIRROR_COOLDOWN = 600  # seconds before a failing mirror is trusted again
+
+mirror_stats = {}
+mirror_lock = threading.Lock()
+
+
+def load_mirror_stats(data_dir):
+    global mirror_stats
+    try:
+        with open(os.path.join(data_dir, MIRROR_STATS_NAME), 'r') as f:
+            stats = json.load(f)
+    except (IOError, ValueError):
+        stats = {}
+    with mirror_lock:
+        mirror_stats = dict((base, stats.get(base, {})) for base in ARCHIVE_MIRRORS)
+
+
+def save_mirror_stats(data_dir):
+    os.makedirs(data_dir, exist_ok=True)
+    with mirror_lock:
+        with open(os.path.join(data_dir, MIRROR_STATS_NAME), 'w') as f:
+            json.dump(mirror_stats, f, indent=1)
+
+
+def record_mirror(base, latency=None, throughput=None, failed=False):
+    # running averages of latency (s) and throughput (bytes/s) per mirror
+    with mirror_lock:
+        stats = mirror_stats.setdefault(base, {})
+        if failed:
+            stats['failures'] = stats.get('failures', 0) + 1
+            stats['failed'] = time.time()
+            return
+        stats['failures'] = 0
+        if latency is not None:
+            stats['latency'] = latency if 'latency' not in stats else 0.7 * stats['latency'] + 0.3 * latency
+        if throughput is not None:
+            stats['throughput'] = throughput if 'throughput' not in stats else 0.7 * stats['throughput'] + 0.3 * throughput
+
+
+def probe_mirrors():
+    for base in ARCHIVE_MIRRORS:
+        time_start = time.time()
+        try:
+            page = request.urlopen(request.Request(base, method='HEAD'), timeout=10)
+            page.close()
+            record_mirror(base, latency=time.time() - time_start)
+        except error.HTTPError:
+            # the server answered, which is all a latency probe needs
+            record_mirror(base, latency=time.time() - time_start)
+        except Exception:
+            record_mirror(base, failed=True)
+
+
+def start_mirror_probe():
+    probe = threading.Thread(target=probe_mirrors, daemon=True)
+    probe.start()
+    return probe
+
+
+def mirror_rank():
+    # healthy mirrors first, then by expected time to fetch a 1 MB product
+    now = time.time()
+    with mirror_lock:
+        def score(item):
+            order, base = item
+            stats = mirror_stats.get(base, {})
+            failing = stats.get('failures', 0) >= MIRROR_MAX_FAILURES and now - stats.get('failed', 0) < MIRROR_COOLDOWN
+            expected = stats.get('latency', 1.0) + 1048576.0 / stats.get('throughput', 1048576.0)
+            return (failing, expected, order)
+
+        return [base for order, base in sorted(enumerate(ARCHIVE_MIRRORS), key=score)]
+
+
+def mirror_urls(url):
+    # (mirror, url) for every mirror that can serve url, best ranked first
+    proper_url = url.replace('\\','/')
+    if not proper_url.startswith(pdsimg_path):
+        return [(None, proper_url)]
+
+    path = proper_url[len(pdsimg_path):]
+    candidates = []
+    for base in mirror_rank():
+        layout = ARCHIVE_MIRRORS[base]
+        if layout is None:
+            candidates.append((base, base + path))
+            continue
+        for prefix, mirror_prefix in layout.items():
+            if path.startswith(prefix):
+                candidates.append((base, base + mirror_prefix + path[len(prefix):]))
+                break
+
+    return candidates
+
+
+def fetch_with_failover(url, target, headers={}, mirror=None, timeout=None):
+    # fetch_to_file() from the best mirror, falling over to the next one when a mirror fails and
+    # retrying all of them with exponential backoff. A product missing from every mirror (404)
+    # is not retried.
+    # mirror: base of the mirror that served the cached copy of target. It is tried first, and an
+    # If-None-Match header only goes to it, etags of one server mean nothing to another.
+    # Returns the status, the response headers and the base of the mirror that answered.
+    delay = MIRROR_BACKOFF
+    status, response = None, {}
+
+    candidates = mirror_urls(url)
+    if mirror is not None:
+        candidates.sort(key=lambda candidate: candidate[0] != mirror)
+
+    for attempt in range(0, MIRROR_RETRIES):
+        transient = False
+
+        for base, mirror_url in candidates:
+            mirror_headers = headers
+            if mirror is not None and base != mirror and 'If-None-Match' in headers:
+                mirror_headers = dict((key, value) for key, value in headers.items() if key != 'If-None-Match')
+
+            time_start = time.time()
+            status, response = fetch_to_file(mirror_url, target, mirror_headers, timeout)
+            elapsed = max(time.time() - time_start, 0.001)
+
+            if status in (200, 206, 304, 416):
+                if base is not None:
+                    throughput = os.path.getsize(target) / elapsed if status == 200 else None
+                    record_mirror(base, latency=None if throughput else elapsed, throughput=throughput)
+                return status, response, base
+
+            if status is None or status >= 500 or status == 429:
+                transient = True
+                if base is not None:
+                    record_mirror(base, failed=True)
+
+        if not transient:
+            break
+
+        if attempt < MIRROR_RETRIES - 1:
+            print('All mirrors failed for %s, retrying in %.0f s' %(url, delay))
+            time.sleep(delay)
+            delay = delay * 2
 
-            if page.getcode() is not 200:
-                return False
+    return status, response, None
 
-            request.urlretrieve(proper_url, localfile)
-            return True
 
-        except:
-            return False
+def read_validators(filename):
+    try:
+        with open(filename + '.json', 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_validators(filename, url, response, mirror=None):
+    # ETag/Last-Modified of a cached product, used for conditional revalidation, and the base of
+    # the mirror that served it, which the validators belong to
+    meta = {'url': url.replace('\\','/'),
+            'etag': response.get('etag'),
+            'last_modified': response.get('last-modified'),
+            'mirror': mirror,
+            'checked': time.time()}
+    with open(filename + '.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def download_file(url, localfile):
+    status, response, mirror = fetch_with_failover(url, localfile)
+    if status != 200:
+        print('Fail to reach a server ({}): {}'.format(status, url))
+        return False
+
+    write_validators(localfile, url, response, mirror)
+    return True
+
+
+def cached_file(job, filename, url):
+    # True when filename is in the cache. Once the job's revalidate interval has passed since the last
+    # check, a conditional request confirms the copy (304) or replaces it with the changed product.
+    if not os.path.isfile(filename):
+        return False
+    if job.revalidate_interval <= 0:
+        return True
+
+    meta = read_validators(filename)
+    if time.time() - meta.get('checked', os.path.getmtime(filename)) < job.revalidate_interval:
+        return True
+
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    # products cached before validators were kept are compared by their file date
+    headers['If-Modified-Since'] = meta.get('last_modified') or formatdate(os.path.getmtime(filename), usegmt=True)
+
+    status, response, mirror = fetch_with_failover(url, filename, headers, meta.get('mirror'))
+
+    if status == 200:
+        print('Product changed in archive, cache updated: ', filename)
+        write_validators(filename, url, response, mirror)
+    elif status == 304:
+        meta['checked'] = time.time()
+        write_validators(filename, url, {'etag': meta.get('etag'), 'last-modified': meta.get('last_modified')},
+                         meta.get('mirror'))
+    else:
+        # offline or archive trouble: keep using the cached copy
+        print('Could not revalidate %s (%s), using cached copy' %(filename, status))
+
+    return True
 
 
 def tosol(rover, nameID):
@@ -295,355 +819,981 @@ def tosol(rover, nameID):
 
     # origin: https://github.com/natronics/MSL-Feed/blob/master/nasa.py
     # function hacked to return sol from image filename
-    craft_time = None
+    return int(tosol_bulk([rover], [nameID])[0])
 
-    if rover == CURIOSITY:
-        craft_time = nameID[4:13]
-    if rover == OPPORTUNITY or rover == SPIRIT:
-        craft_time = nameID[2:11] 
 
-    s = int(craft_time)
-    MSD = (s/88775.244) + 44795.9998
+# clock digits in the image id and sol offset of the clock based estimate, per rover
+SOL_CLOCK = {
+    SPIRIT: (slice(2, 11), 3048),
+    OPPORTUNITY: (slice(2, 11), 3028),
+    CURIOSITY: (slice(4, 13), -6),
+}
+
+
+def tosol_bulk(rovers, nameIDs):
+    # tosol() for a whole batch at once
+    craft_time = np.array([int(nameID[SOL_CLOCK[rover][0]]) for rover, nameID in zip(rovers, nameIDs)], dtype=np.float64)
+    deviate = np.array([SOL_CLOCK[rover][1] for rover in rovers], dtype=np.int64)
+
+    MSD = (craft_time/88775.244) + 44795.9998
 
     sol = MSD - 49269.2432411704
     sol = sol + 1  # for sol 0
-    sol = int(math.ceil(sol))
+    sol = np.ceil(sol).astype(np.int64)
 
-    deviate = None
+    return sol + deviate
 
-    if rover == CURIOSITY:
-        deviate = -6
-    if rover == OPPORTUNITY:
-        deviate = 3028
-    if rover == SPIRIT:
-        deviate = 3048
 
-    return sol+deviate
+# -----------------------------------------------------------------------------
+# Product id resolver
+
+# image id prefix: rover, camera, PDS data directory, image (texture) directory
+CAMERA_TABLE = {
+    '2N': (SPIRIT, 'navcam', 'mer/mer2no_0xxx/data/', 'mer/gallery/all/2/n/'),
+    '2P': (SPIRIT, 'pancam', 'mer/mer2po_0xxx/data/', 'mer/gallery/all/2/p/'),
+    '2F': (SPIRIT, 'fhazcam', 'mer/mer2ho_0xxx/data/', 'mer/gallery/all/2/h/'),
+    '2R': (SPIRIT, 'rhazcam', 'mer/mer2ho_0xxx/data/', 'mer/gallery/all/2/h/'),
+    '1N': (OPPORTUNITY, 'navcam', 'mer/mer1no_0xxx/data/', 'mer/gallery/all/1/n/'),
+    '1P': (OPPORTUNITY, 'pancam', 'mer/mer1po_0xxx/data/', 'mer/gallery/all/1/p/'),
+    '1F': (OPPORTUNITY, 'fhazcam', 'mer/mer1ho_0xxx/data/', 'mer/gallery/all/1/h/'),
+    '1R': (OPPORTUNITY, 'rhazcam', 'mer/mer1ho_0xxx/data/', 'mer/gallery/all/1/h/'),
+    'N': (CURIOSITY, 'navcam', None, None),
+}
+
+# MSL data before this sol lives in the V1 directories
+MSL_V1_SOL = 1870
+MSL_DIRS = {
+    True: ('msl/MSLNAV_1XXX/DATA_V1/', 'msl/MSLNAV_1XXX/EXTRAS_V1/FULL/'),
+    False: ('msl/MSLNAV_1XXX/DATA/', 'msl/MSLNAV_1XXX/EXTRAS/FULL/'),
+}
+
+ID_LENGTH = {SPIRIT: 27, OPPORTUNITY: 27, CURIOSITY: 36}
+
+# character substitutions turning an image id into a product name
+PRODUCT_CODES = {
+    'XYZ': {'MER': ((11, 'xyl'), (25, 'm')), 'MSL': ((13, 'XYZ'), (35, '1'))},
+    'RAD': {'MER': ((11, 'mrd'), (25, 'm')), 'MSL': ((13, 'RAD'), (35, '1'))},
+    'RAS': {'MSL': ((13, 'RAS'), (35, '1'))},
+    # MER EDR textures:
+    # Full frame EDR “EFF”
+    # Sub-frame EDR “ESF”
+    # Downsampled EDR “EDN”
+    # Thumbnail EDR “ETH”
+    # Row Summed EDR “ERS”
+    # Column Summed EDR “ECS”
+    # Reference Pixels EDR “ERP”
+    # Histogram EDR “EHG”
+    'EFF': {'MER': ((11, 'eff'), (25, 'm'))},
+    'EDN': {'MER': ((11, 'edn'), (25, 'm'))},
+    # alternative (linearized full frame) texture
+    'FFL': {'MER': ((11, 'ffl'), (25, 'm'))},
+}
 
 
-def get_texture_image(rover, sol, imgname):
-    global roverImageDir, local_data_dir, localfile
+def product_name(rover, imgname, code, ext):
+    s = list(imgname + ext)
+    mission = 'MSL' if rover == CURIOSITY else 'MER'
+    for pos, chars in PRODUCT_CODES[code][mission]:
+        s[pos:pos + len(chars)] = chars
+    return "".join(s)
 
+
+def texture_codes(rover, imgname):
+    # texture products to try, in order
     if rover == CURIOSITY:
-        if sol > 450:
-            texname = '%s.PNG' %( imgname )
-        else:
-            texname = '%s.JPG' %( imgname )
+        return ['RAS']
+    # sequence (“P”  -  PMA & Remote Sensing instr.  (Pancam, Navcam, Hazcam, MI, Mini-TES)
+    if imgname[18] == 'F':
+        #mer downsampled??
+        return ['EDN', 'FFL']
+    return ['EFF', 'FFL']
+
+
+def data_paths(product, name, data_dir):
+    # local and remote location of a product in the PDS data directory
+    sol = product.sol
+    local = os.path.join(data_dir, product.data_dir, 'sol%05d' %(sol), name)
+    if product.rover == CURIOSITY:
+        remote = os.path.join(os.path.dirname(pdsimg_path), product.data_dir, 'SOL%05d' %(sol), name)
     else:
-        texname = '%s.JPG' %( imgname )
+        remote = os.path.join(os.path.dirname(pdsimg_path), product.data_dir, 'sol%04d' %(sol), 'rdr', name.lower())
+    return local, remote
 
-    s = list( texname )
 
-    if rover == CURIOSITY:
-        s[13] = 'R'
-        s[14] = 'A'
-        s[15] = 'S'
-        s[35] = '1'
+def image_paths(product, name, data_dir):
+    # local and remote location of a texture image
+    sol = product.sol
+    local = os.path.join(data_dir, product.image_dir, '%05d' %(sol), name)
+    if product.rover == CURIOSITY:
+        remote = os.path.join(os.path.dirname(pdsimg_path), product.image_dir, 'SOL%05d' %(sol), name)
     else:
-    # Full frame EDR “EFF” 
-    # Sub-frame EDR “ESF” 
-    # Downsampled EDR “EDN” 
-    # Thumbnail EDR “ETH” 
-    # Row Summed EDR “ERS”
-    # Column Summed EDR “ECS” 
-    # Reference Pixels EDR “ERP” 
-    # Histogram EDR “EHG”
+        remote = os.path.join(os.path.dirname(nasaimg_path), product.image_dir, '%03d' %(sol), name.upper())
+    return local, remote
+
+
+def resolve_products(ids, data_dir):
+    # Parse and validate a batch of image ids and map them to rover, camera, sol and the local and
+    # remote paths of their XYZ, RAD and texture products. Returns (products, errors) where errors
+    # holds (id, error code) for every rejected id, see ERROR_MESSAGES.
+    products = []
+    errors = []
+
+    for rawID in ids:
+        theString = os.path.splitext(rawID.strip( ' ' ))[0].upper() # case insensitive
+        if len(theString) == 0:
+            continue
+
+        entry = CAMERA_TABLE.get(theString[:2]) or CAMERA_TABLE.get(theString[:1])
+        if entry is None:
+            errors.append((theString, 4))
+            continue
+
+        rover, camera, data_dir_name, image_dir_name = entry
+        if len(theString) != ID_LENGTH[rover]:
+            errors.append((theString, 3))
+            continue
+        if not theString[SOL_CLOCK[rover][0]].isdigit():
+            errors.append((theString, 4))
+            continue
+
+        products.append(ProductRequest(theString, rover, camera, data_dir_name, image_dir_name))
 
-        if s[18] == 'F' or s[18] == 'f':  # sequence (“P”  -  PMA & Remote Sensing instr.  (Pancam, Navcam, Hazcam, MI, Mini-TES) 
-            #mer downsampled??
-            s[11] = 'e'
-            s[12] = 'd'
-            s[13] = 'n'
-            s[25] = 'm'  
+    if len(products) == 0:
+        return products, errors
+
+    sols = tosol_bulk([p.rover for p in products], [p.id for p in products])
+
+    for product, sol in zip(products, sols):
+        rover = product.rover
+        imgname = product.id
+        product.sol = sol = int(sol)
+
+        if rover == CURIOSITY:
+            product.data_dir, product.image_dir = MSL_DIRS[sol < MSL_V1_SOL]
+
+        product.xyz = data_paths(product, product_name(rover, imgname, 'XYZ', '.IMG'), data_dir)
+        product.rad = data_paths(product, product_name(rover, imgname, 'RAD', '.IMG'), data_dir)
+
+        if rover == CURIOSITY and sol > 450:
+            ext = '.PNG'
         else:
-            s[11] = 'e'
-            s[12] = 'f'
-            s[13] = 'f'
-            s[25] = 'm'  
-
-    imagename = '%s' % "".join(s)
-    print ('local_data_dir :', local_data_dir)
-    print ('roverImageDir :', roverImageDir)
-    print ('sol :', sol )
-    print ('imagename :', imagename)
-    imgfilename = os.path.join(local_data_dir, roverImageDir, '%05d' %(sol), imagename )
-   
-    print('Looking for EFF texture in cache: ', imgfilename)
-    if os.path.isfile(imgfilename):
-        print('Loading EFF texture from cache: ', imgfilename)
-        return imgfilename
-    else :
-      s[11] = 'f'
-      s[12] = 'f'
-      s[13] = 'l'
-      s[25] = 'm'  
-      imagename2 = '%s' % "".join(s)
-      imgfilename2 = os.path.join(local_data_dir, roverImageDir, '%05d' %(sol), imagename2 )
-      print('EFF texture not found; looking for alternative (FFL) texture in cache: ', imgfilename2)
-      if os.path.isfile(imgfilename2):
-          print('Loading FFL texture from cache: ', imgfilename2)
-          return imgfilename2
-    
-    # Nothing in cache: try downloading...
-    
-    retrievedir = os.path.join(os.path.dirname(local_data_dir), roverImageDir, '%05d' %( sol ) )
-    print ('Texture files are cached into ', retrievedir)
-    if not os.path.exists(retrievedir):
-        os.makedirs(retrievedir)
+            ext = '.JPG'
+        product.textures = [image_paths(product, product_name(rover, imgname, code, ext), data_dir)
+                               for code in texture_codes(rover, imgname)]
 
-   # Try first with EFF texture:
-    localfile = imgfilename
+    return products, errors
 
-    if rover == OPPORTUNITY or rover == SPIRIT:
-        remotefile = os.path.join(os.path.dirname(nasaimg_path), roverImageDir, '%03d' %(sol), imagename.upper() )
-    if rover == CURIOSITY:
-        remotefile = os.path.join(os.path.dirname(pdsimg_path), roverImageDir, 'SOL%05d' %(sol), imagename )
 
-    print('Trying to download texture data: ', remotefile)
+def get_texture_image(job, product):
+    # try the cache first, for every texture candidate (EFF before FFL)
+    for imgfilename, remotefile in product.textures:
+        print('Looking for texture in cache: ', imgfilename)
+        if cached_file(job, imgfilename, remotefile):
+            print('Loading texture from cache: ', imgfilename)
+            return imgfilename
 
-    result = download_file(remotefile)
-    if(result == False):
-      # No EFF texture, try with FFL:
-      print ('Cannot find EFF texture: ', remotefile)
-      localfile = imgfilename2  
-      if rover == OPPORTUNITY or rover == SPIRIT:
-          remotefile = os.path.join(os.path.dirname(nasaimg_path), roverImageDir, '%03d' %(sol), imagename2.upper() )
-      if rover == CURIOSITY:
-          remotefile = os.path.join(os.path.dirname(pdsimg_path), roverImageDir, 'SOL%05d' %(sol), imagename2 )
-  
-      print('Trying to download alternative (FFL) texture data: ', remotefile)
-      
-      result = download_file(remotefile)
-      if(result == False):
-         print ('Cannot find texture: ', remotefile)
-         ShowMessageBox('Sorry, cant find texture ' + remotefile, 'TEXTURE ERROR')
-         return None
-      else :
-         imgfilename = imgfilename2
-    
-    if os.path.isfile(localfile):
-        print ('Texture file successfully downloaded: ',imgfilename) 
-        return imgfilename
+    # Nothing in cache: try downloading...
 
+    for imgfilename, remotefile in product.textures:
+        retrievedir = os.path.dirname(imgfilename)
+        print ('Texture files are cached into ', retrievedir)
+        os.makedirs(retrievedir, exist_ok=True)
 
-def get_16bit_texture_image(rover, sol, imgname):
-    global roverImageDir, local_data_dir, localfile
+        print('Trying to download texture data: ', remotefile)
 
-    texname = '%s.IMG' %( imgname )
-    s = list( texname )
+        result = download_file(remotefile, imgfilename)
+        if result == True and os.path.isfile(imgfilename):
+            print ('Texture file successfully downloaded: ',imgfilename)
+            return imgfilename
 
-    if rover == CURIOSITY:
-        s[13] = 'R'
-        s[14] = 'A'
-        s[15] = 'D'
-        s[35] = '1'
-    else:
-        s[11] = 'm'
-        s[12] = 'r'
-        s[13] = 'd'
-        s[25] = 'm'
+        print ('Cannot find texture: ', remotefile)
 
-    imagename = '%s' % "".join(s)
-    imgfilename = os.path.join(local_data_dir, roverDataDir, 'sol%05d' %(sol), imagename )
+    return None
 
-    if os.path.isfile(imgfilename):
+
+def get_16bit_texture_image(job, product):
+    imgfilename, remotefile = product.rad
+
+    if cached_file(job, imgfilename, catalog_remote(job, imgfilename, remotefile) or remotefile):
         print('Loading 16 bit texture (rad) from cache: ', imgfilename)
         return imgfilename
 
-    retrievedir = os.path.join(os.path.dirname(local_data_dir), roverDataDir, 'sol%05d' %( sol ) )
+    retrievedir = os.path.dirname(imgfilename)
     print ('16 bit texture files (rad) are cached into ', retrievedir)
-    if not os.path.exists(retrievedir):
-        os.makedirs(retrievedir)
-
-    localfile = imgfilename
+    os.makedirs(retrievedir, exist_ok=True)
 
-    if rover == OPPORTUNITY or rover == SPIRIT:
-        remotefile = os.path.join(os.path.dirname(pdsimg_path), roverDataDir, 'sol%04d' %(sol), 'rdr', imagename.lower() )
-    if rover == CURIOSITY:
-        remotefile = os.path.join(os.path.dirname(pdsimg_path), roverDataDir, 'SOL%05d' %(sol), imagename )
+    remotefile = catalog_remote(job, imgfilename, remotefile)
+    if remotefile is None:
+        print('16 bit texture (rad) not in volume catalog: ', imgfilename)
+        return None
 
     print('Downloading 16 bit texture (rad): ', remotefile)
 
-    result = download_file(remotefile)
+    result = download_file(remotefile, imgfilename)
     if(result == False):
         return None
 
-    if os.path.isfile(localfile):
+    if os.path.isfile(imgfilename):
         return imgfilename
 
 
-def get_depth_image(rover, sol, imgname):
-    global roverDataDir, local_data_dir, localfile
-
-    xyzname = '%s.IMG' %( imgname )
-    s = list( xyzname )
-
-    if rover == CURIOSITY:
-        s[13] = 'X'
-        s[14] = 'Y'
-        s[15] = 'Z'
-        s[35] = '1'
-    else :
-        s[11] = 'x'
-        s[12] = 'y'
-        s[13] = 'l'
-        s[25] = 'm' 
-
-    xyzname = '%s' % "".join(s)
-    xyzfilename = os.path.join(local_data_dir, roverDataDir, 'sol%05d' %(sol), xyzname )
+def get_depth_image(job, product):
+    xyzfilename, remotefile = product.xyz
 
-    if os.path.isfile(xyzfilename):
+    if cached_file(job, xyzfilename, catalog_remote(job, xyzfilename, remotefile) or remotefile):
         print('Loading xyz data from cache: ', xyzfilename)
         return xyzfilename
 
-    retrievedir = os.path.join(local_data_dir, roverDataDir, 'sol%05d' %(sol) )
+    retrievedir = os.path.dirname(xyzfilename)
     print ('3d files (xyz) are cached into ', retrievedir)
-    if not os.path.exists(retrievedir):
-        os.makedirs(retrievedir)
-
-    localfile = xyzfilename
+    os.makedirs(retrievedir, exist_ok=True)
 
-    if rover == OPPORTUNITY or rover == SPIRIT:
-        remotefile = os.path.join(os.path.dirname(pdsimg_path), roverDataDir, 'sol%04d' %(sol), 'rdr', xyzname.lower() )
-    if rover == CURIOSITY:
-        remotefile = os.path.join(os.path.dirname(pdsimg_path), roverDataDir, 'SOL%05d' %(sol), xyzname )
+    remotefile = catalog_remote(job, xyzfilename, remotefile)
+    if remotefile is None:
+        print('xyz product not in volume catalog: ', xyzfilename)
+        return None
 
     print('downloading xyz: ', remotefile)
 
-    result = download_file(remotefile)
+    result = download_file(remotefile, xyzfilename)
     if(result == False):
         return None
 
-    if os.path.isfile(localfile):
+    if os.path.isfile(xyzfilename):
         return xyzfilename
 
 
-def convert_to_png(image_16bit_texture_filename):
-    global curve_minval, curve_maxval
+# -----------------------------------------------------------------------------
+# Batch planning from label-only range requests
 
-    LINES = LINE_SAMPLES = SAMPLE_BITS = BYTES = 0
-    SAMPLE_TYPE = ""
+LABEL_CHUNK = 16384  # bytes requested per range request while looking for the end of a label
+LABEL_TIMEOUT = 20  # seconds, a stalled server leaves the product to the download and its retries
 
-    FileAndPath = image_16bit_texture_filename
-    FileAndExt = os.path.splitext(FileAndPath)
 
-    print('creating png...')
+def label_complete(text):
+    return any(line.strip() == "END" for line in text.splitlines())
 
-    # Open the img file (ascii label part)
-    try:
-        if FileAndExt[1].isupper():
-            f = open(FileAndExt[0] + ".IMG", 'r')
+
+def read_range(url, start, end):
+    # Bytes start..end of url as (status, data), status None when the server cannot be reached.
+    # Servers ignoring the range send the whole product, only what was asked for is read.
+    if sys.platform == 'darwin':
+        # through curl like every other download, see fetch_to_file()
+        handle, scratch = tempfile.mkstemp(suffix='.LBL')
+        os.close(handle)
+        data = b''
+        try:
+            status, response = fetch_to_file(url, scratch, {'Range': 'bytes=%d-%d' %(start, end)},
+                                             LABEL_TIMEOUT, (200, 206))
+            if status in (200, 206):
+                with open(scratch, 'rb') as f:
+                    data = f.read(end + 1)
+        finally:
+            if os.path.isfile(scratch):
+                os.remove(scratch)
+    else:
+        try:
+            page = request.urlopen(request.Request(url, headers={'Range': 'bytes=%d-%d' %(start, end)}),
+                                   timeout=LABEL_TIMEOUT)
+            status = page.getcode()
+            try:
+                data = page.read(LABEL_CHUNK if status == 206 else end + 1)
+            finally:
+                page.close()
+        except error.HTTPError as e:
+            return e.code, b''
+        except Exception as e:
+            print('Cannot reach %s: %s' %(url, e))
+            return None, b''
+
+    if status == 200:
+        data = data[start:]
+    return status, data
+
+
+def prefetch_label(url):
+    # Fetch only the PDS label at the start of a remote product, from the first mirror that
+    # has it. Returns (label, missing): the parsed label or None, and whether every mirror
+    # answered that the product does not exist (404 or 410). Timeouts and other failures are
+    # not taken as missing, the download with its retries decides about those products.
+    candidates = mirror_urls(url)
+    missing = len(candidates) > 0
+    for base, mirror_url in candidates:
+        text = ''
+        start = 0
+
+        while not label_complete(text):
+            end = start + LABEL_CHUNK - 1
+            time_start = time.time()
+            status, chunk = read_range(mirror_url, start, end)
+            if status not in (404, 410):
+                missing = False
+            if status not in (200, 206):
+                print('Cannot read label from %s (%s)' %(mirror_url, status))
+                if base is not None and status is None:
+                    record_mirror(base, failed=True)
+                break
+
+            if base is not None:
+                record_mirror(base, latency=time.time() - time_start)
+
+            if not chunk:
+                break
+
+            text = text + chunk.decode('ascii', errors='replace')
+            start = end + 1
+
+        if label_complete(text):
+            return parse_pds_label(text.splitlines()), False
+
+    return None, missing
+
+
+def product_bytes(label):
+    # size of the whole product file as described by its label
+    if label['RECORD_BYTES'] and label['FILE_RECORDS']:
+        return label['RECORD_BYTES'] * label['FILE_RECORDS']
+    return label['LINES'] * label['LINE_SAMPLES'] * label['BANDS'] * max(label['SAMPLE_BITS'], 8) // 8
+
+
+def plan_label(job, product):
+    # xyz label of a product from the cache or with range requests, runs on a worker thread.
+    # Returns (label, bytes to download, not found, remote url).
+    xyzfilename, remotefile = product.xyz
+
+    if os.path.isfile(xyzfilename):
+        return read_pds_label(xyzfilename), 0, False, remotefile
+
+    remotefile = catalog_remote(job, xyzfilename, remotefile)
+    label, not_found = prefetch_label(remotefile) if remotefile else (None, True)
+    return label, product_bytes(label) if label else 0, not_found, remotefile
+
+
+def plan_batch(job, products):
+    # Read the xyz label of every product (from the cache, or with range requests on job.workers
+    # threads), estimate vertices, download volume and decoder memory, and order the batch
+    # largest first.
+    # Returns (products, missing) with the products the catalog or every mirror reports missing
+    # left out. Products whose label cannot be read are kept with an unknown size and go last.
+    planned = []
+    missing = []
+    unknown = 0
+    download = 0
+
+    with ThreadPoolExecutor(max_workers=job.workers) as pool:
+        labels = list(pool.map(lambda product: plan_label(job, product), products))
+
+    for product, (label, size, not_found, remotefile) in zip(products, labels):
+        if label is None and not_found:
+            print('xyz product not available: ', remotefile)
+            missing.append(product)
+            continue
+
+        if label is None or label['LINES'] == 0:
+            print('xyz label not readable, size unknown: ', remotefile)
+            product.plan = {'vertices': 0, 'download': None, 'memory': 0}
+            unknown = unknown + 1
         else:
-            f = open(FileAndExt[0] + ".img", 'r')
-    except:
-        return
+            product.plan = {'vertices': label['LINES'] * label['LINE_SAMPLES'],
+                            'download': size,
+                            'memory': decode_memory(label['LINES'], label['LINE_SAMPLES'],
+                                                    job.mode in ('POINTS', 'DEM') or job.max_range > 0 or job.detail_range > 0,
+                                                    job.mode == 'MESH' and (job.shading or job.smooth))}
+            download = download + size
+        planned.append(product)
 
-    block = ""
-    OFFSET = 0
-    for line in f:
-        if line.strip() == "END":
-            break
-        tmp = line.split("=")
-        if tmp[0].strip() == "OBJECT" and tmp[1].strip() == "IMAGE":
-            block = "IMAGE"
-        elif tmp[0].strip() == "END_OBJECT" and tmp[1].strip() == "IMAGE":
-            block = ""
-        if tmp[0].strip() == "OBJECT" and tmp[1].strip() == "IMAGE_HEADER":
-            block = "IMAGE_HEADER"
-        elif tmp[0].strip() == "END_OBJECT" and tmp[1].strip() == "IMAGE_HEADER":
-            block = ""
+    planned.sort(key=lambda product: product.plan['vertices'], reverse=True)
 
-        if block == "IMAGE":
-            if line.find("LINES") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                LINES = int(tmp[1].strip())
-            elif line.find("LINE_SAMPLES") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                LINE_SAMPLES = int(tmp[1].strip())
-            elif line.find("SAMPLE_TYPE") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                SAMPLE_TYPE = tmp[1].strip()
-            elif line.find("SAMPLE_BITS") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                SAMPLE_BITS = int(tmp[1].strip())
+    if planned:
+        print('Batch plan: %d products, up to %d vertices, %.1f MB xyz to download, %.1f MB peak decoder memory'
+              %(len(planned), sum(p.plan['vertices'] for p in planned), download / 1048576.0,
+                max(p.plan['memory'] for p in planned) / 1048576.0))
+    if unknown:
+        print('Batch plan: %d products of unknown size' %(unknown))
+    if missing:
+        print('Batch plan: %d products not available: %s' %(len(missing), ', '.join(p.id for p in missing)))
 
-        if block == "IMAGE_HEADER":
-            if line.find("BYTES") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                BYTES = int(tmp[1].strip())
+    return planned, missing
 
-    f.close
 
-    # Open the img file (binary data part)
+# -----------------------------------------------------------------------------
+# Import pipeline: downloads, RAD conversion and xyz decoding run on worker threads while the
+# main thread builds Blender data for the products that are ready
+
+
+def fetch_texture(job, product):
+    # texture stage, returns the texture filename and keeps the curve range of its values
+    time_start = time.time()
     try:
-        if FileAndExt[1].isupper():
-            f2 = open(FileAndExt[0] + ".IMG", 'rb')
+        return fetch_texture_file(job, product)
+    finally:
+        product.timings['texture'] = time.time() - time_start
+
+
+def fetch_texture_file(job, product):
+    if job.rad:
+        image_16bit_texture_filename = get_16bit_texture_image(job, product)
+        if image_16bit_texture_filename is None:
+            return None
+        stretch = (job.stretch_clip, job.stretch_gamma) if job.stretch else None
+        pngname, product.curve = convert_to_png(image_16bit_texture_filename, job.proxy_level, stretch)
+        return pngname
+
+    return get_texture_image(job, product)
+
+
+def fetch_depth(job, product, memory_limit):
+    # depth stage: download and decode, independent of the texture
+    time_start = time.time()
+    try:
+        image_depth_filename = get_depth_image(job, product)
+        if image_depth_filename is None:
+            return None
+        return load_depth_product(image_depth_filename, job.fill, memory_limit, job.max_stretch,
+                                  job.max_range, job.detail_range, job.triangulate, job.mode in ('POINTS', 'DEM'),
+                                  job.shading and job.mode == 'MESH', job.smooth and job.mode == 'MESH')
+    finally:
+        product.timings['depth'] = time.time() - time_start
+
+
+def stage_result(future):
+    try:
+        return future.result()
+    except Exception:
+        traceback.print_exc()
+        return None
+
+
+def pipeline_products(job, products):
+    # Yields (product, depth, texture filename) in the order products become ready.
+    # Only job.workers products are in flight at a time. The next product is submitted before a
+    # finished one is yielded, so up to job.workers + 1 decoded products are held at once: the
+    # one being built and the ones decoding. The memory limit is split between the concurrent
+    # decoders, each decodes with job.memory_limit // job.workers.
+    decode_limit = max(1, job.memory_limit // job.workers)
+    queue = list(products)
+    in_flight = {}
+
+    with ThreadPoolExecutor(max_workers=job.workers * 2) as pool:
+        def submit():
+            product = queue.pop(0)
+            depth_future = pool.submit(fetch_depth, job, product, decode_limit)
+            in_flight[depth_future] = (product, pool.submit(fetch_texture, job, product))
+
+        while queue and len(in_flight) < job.workers:
+            submit()
+
+        while in_flight:
+            done, not_done = wait(in_flight.keys(), return_when=FIRST_COMPLETED)
+            for depth_future in done:
+                product, texture_future = in_flight.pop(depth_future)
+                if queue:
+                    submit()
+
+                yield product, stage_result(depth_future), stage_result(texture_future)
+
+
+def write_png(pngname, gray):
+    # minimal grayscale PNG encoder; gray is a (rows, columns) uint8 or uint16 array, top row first,
+    # written with 8 or 16 bits. Writing the file directly keeps Blender data (and the render
+    # settings) out of the conversion, so it can run on a worker thread.
+    height, width = gray.shape
+    depth = gray.dtype.itemsize
+    raw = np.zeros((height, width * depth + 1), dtype=np.uint8)  # first byte of every row: no filter
+    raw[:, 1:] = gray.astype('>u%d' %(depth)).view(np.uint8).reshape(height, width * depth)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    with open(pngname, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, depth * 8, 0, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+
+def linear_to_srgb(linear):
+    return np.where(linear <= 0.0031308, linear * 12.92, 1.055 * np.power(linear, 1 / 2.4) - 0.055)
+
+
+def read_texture_gray(image_texture_filename):
+    # First channel of a texture as loaded by Blender, top row first, in its stored (sRGB) encoding.
+    # Also returns whether Blender holds the image as floats (16 bit PNG), which it linearizes.
+    img = bpy.data.images.load(image_texture_filename, check_existing=True)
+    width, height = img.size
+    pixels = np.empty(width * height * img.channels, dtype=np.float32)
+    img.pixels.foreach_get(pixels)
+    is_float = img.is_float
+    if img.users == 0:
+        bpy.data.images.remove(img)
+
+    # image rows are stored bottom up
+    gray = pixels.reshape(height, width, -1)[::-1, :, 0]
+    if is_float:
+        gray = linear_to_srgb(np.clip(gray, 0.0, 1.0))
+    return gray, is_float
+
+
+def crop_texture(image_texture_filename, grid_index, LINES, LINE_SAMPLES):
+    # Crop a texture to the bounding box of the grid samples that have xyz data. Returns the
+    # cropped png (written once next to the cached texture) and the box as fractions of the
+    # texture, (left, right, top, bottom), for grid_uvs(); or the texture unchanged and None
+    # when there is nothing to crop.
+    if len(grid_index) == 0:
+        return image_texture_filename, None
+
+    gray, is_float = read_texture_gray(image_texture_filename)
+    height, width = gray.shape
+
+    rows = grid_index // LINE_SAMPLES
+    cols = grid_index % LINE_SAMPLES
+    x0 = int(cols.min()) * width // LINE_SAMPLES
+    x1 = min(width, -(-(int(cols.max()) + 1) * width // LINE_SAMPLES))
+    y0 = int(rows.min()) * height // LINES
+    y1 = min(height, -(-(int(rows.max()) + 1) * height // LINES))
+
+    if (x1 - x0) * (y1 - y0) == width * height:
+        return image_texture_filename, None
+
+    cropname = '%s.CROP%d-%d-%d-%d.PNG' %(os.path.splitext(image_texture_filename)[0], x0, x1, y0, y1)
+    if not (os.path.isfile(cropname) and os.path.getmtime(cropname) >= os.path.getmtime(image_texture_filename)):
+        if is_float:
+            write_png(cropname, np.round(gray[y0:y1, x0:x1] * 65535).astype(np.uint16))
         else:
-            f2 = open(FileAndExt[0] + ".img", 'rb')
-    except:
-        return
+            write_png(cropname, np.round(gray[y0:y1, x0:x1] * 255).astype(np.uint8))
 
-    edit = f2.read()
-    meh = edit.find(b'LBLSIZE')
-    f2.seek( meh + BYTES)
+    print('Texture cropped to the depth data: %d x %d of %d x %d' %(x1 - x0, y1 - y0, width, height))
+    return cropname, (x0 / float(width), x1 / float(width), y0 / float(height), y1 / float(height))
 
-    bands = []
-    for bandnum in range(0, 1):
 
-        bands.append([])
-        for linenum in range(0, LINES):
+def proxy_filename(image_texture_filename, level):
+    return '%s.PROXY%d.PNG' %(os.path.splitext(image_texture_filename)[0], level)
 
-            bands[bandnum].append([])
-            for pixnum in range(0, LINE_SAMPLES):
 
-                dataitem = f2.read(2)
-                if (dataitem == ""):
-                    print ('ERROR, Ran out of data to read before we should have')
+def write_proxy_pyramid(image_texture_filename, gray, levels, high_bit=True):
+    # Write proxies of a texture at 1/2, 1/4, ... down to 1/2 ** levels, each level box filtered
+    # from the one before. gray is the (rows, columns) texture in 0..1, top row first.
+    # high_bit: 16 bit proxies for 16 bit textures; 8 bit textures get 8 bit proxies, which
+    # Blender keeps as bytes rather than floats.
+    for level in range(1, levels + 1):
+        rows, columns = gray.shape[0] // 2, gray.shape[1] // 2
+        if rows == 0 or columns == 0:
+            break
+        gray = gray[:rows * 2, :columns * 2].reshape(rows, 2, columns, 2).mean(axis=(1, 3))
+        if high_bit:
+            write_png(proxy_filename(image_texture_filename, level), np.round(gray * 65535).astype(np.uint16))
+        else:
+            write_png(proxy_filename(image_texture_filename, level), np.round(gray * 255).astype(np.uint8))
 
-                bands[bandnum][linenum].append(struct.unpack(">H", dataitem)[0])
 
-    f2.close
+def texture_proxy(image_texture_filename, level):
+    # filename of the proxy of a texture, the pyramid is generated once next to the cached texture
+    proxyname = proxy_filename(image_texture_filename, level)
+    if os.path.isfile(proxyname) and os.path.getmtime(proxyname) >= os.path.getmtime(image_texture_filename):
+        return proxyname
+
+    gray, is_float = read_texture_gray(image_texture_filename)
+    write_proxy_pyramid(image_texture_filename, gray, level, is_float)
+    if not os.path.isfile(proxyname):
+        return None
+    return proxyname
+
+
+def stretch_limits(band, clip):
+    # sample values at the clip and 100 - clip percentiles of a uint16 band, from its histogram
+    cdf = np.cumsum(np.bincount(band.ravel(), minlength=65536))
+    low = int(np.searchsorted(cdf, cdf[-1] * clip / 100.0, side='right'))
+    high = int(np.searchsorted(cdf, cdf[-1] * (1.0 - clip / 100.0), side='left'))
+    return low, max(high, low + 1)
+
+
+def convert_to_png(image_16bit_texture_filename, proxy_levels=0, stretch=None):
+    # Convert a 16 bit RAD product to PNG. Returns the png filename and the (min, max) range of
+    # the linear values, used for the curves node of the material. With proxy_levels, the proxy
+    # pyramid of the png is written as well.
+    # stretch: (clip percent, gamma) bakes a contrast stretch between the clip percentiles into the
+    # png instead, the curve range is then (0, 1). Stretched pngs are reused while they are newer
+    # than the RAD product.
+    if stretch is not None:
+        pngname = '%s.STRETCH_%g_%g.PNG' %(os.path.splitext(image_16bit_texture_filename)[0], stretch[0], stretch[1])
+        if os.path.isfile(pngname) and os.path.getmtime(pngname) >= os.path.getmtime(image_16bit_texture_filename):
+            print('Loading stretched png from cache: ', pngname)
+            return pngname, (0.0, 1.0)
+    else:
+        pngname = os.path.splitext(image_16bit_texture_filename)[0] + '.PNG'
+
+    print('creating png...')
+
+    label = read_pds_label(image_16bit_texture_filename)
+    if label is None:
+        return None, (0.0, 1.0)
+
+    LINES = label['LINES']
+    LINE_SAMPLES = label['LINE_SAMPLES']
+    dtype = np.dtype('<u2') if label['SAMPLE_TYPE'].startswith('LSB_') else np.dtype('>u2')
+
+    with open(image_16bit_texture_filename, 'rb') as f2:
+        offset = find_image_offset(f2, label['BYTES'])
+        if offset is None:
+            return None, (0.0, 1.0)
+        f2.seek(offset)
+        band = np.fromfile(f2, dtype=dtype, count=LINES * LINE_SAMPLES)
+
+    if band.size != LINES * LINE_SAMPLES:
+        print ('ERROR, Ran out of data to read before we should have')
+        return None, (0.0, 1.0)
+
+    band = band.reshape(LINES, LINE_SAMPLES)
+
+    if stretch is not None:
+        clip, gamma = stretch
+        low, high = stretch_limits(band, clip)
+        # the stretched values are stored as they should be displayed
+        srgb = np.clip((band.astype(np.float32) - low) / (high - low), 0.0, 1.0)
+        if gamma != 1.0:
+            srgb = np.power(srgb, 1.0 / gamma)
+        curve = (0.0, 1.0)
+    else:
+        linear = band.astype(np.float32) / (32768*2)
+        curve = (float(linear.min()), float(linear.max()))
+
+        # stored sRGB encoded, so Blender's default color space loads the linear values back
+        srgb = linear_to_srgb(linear)
+
+    write_png(pngname, np.round(srgb * 65535).astype(np.uint16))
+    if proxy_levels > 0:
+        write_proxy_pyramid(pngname, srgb, proxy_levels)
+
+    return pngname, curve
+
+
+# -----------------------------------------------------------------------------
+# Product .blend cache: the finished mesh, material, camera and caption of a product are written
+# once to a .blend file and appended by later imports with the same settings
+
+# directory below the data directory holding the product .blend files
+ASSET_CACHE_DIR = 'blend'
 
-    pixels = [None] * LINES * LINE_SAMPLES
 
-    curve_minval = 1.0
-    curve_maxval = 0.0
+def product_settings_key(job):
+    # hash of the settings of job that change the mesh of a product or its material
+    settings = (job.fill, job.rad, job.max_stretch, job.max_range, job.detail_range, job.triangulate,
+                job.crop, job.stretch, job.stretch_clip, job.stretch_gamma, job.shading, job.smooth,
+                job.pack, job.pack_scale, job.proxy_level)
+    return '%08x' %(zlib.crc32(repr(settings).encode('ascii')))
 
-    for j in range(0, LINES):
-        for k in range(0, LINE_SAMPLES):
 
-            r = g = b = float(bands[0][LINES-1 - j][k] & 0xffff )  / (32768*2)
-            a = 1.0
-            pixels[(j * LINES) + k] = [r, g, b, a]
+def texture_settings_key(job):
+    # hash of the settings of job that change the material of a product or its images
+    settings = (job.rad, job.crop, job.stretch, job.stretch_clip, job.stretch_gamma, job.shading,
+                job.pack, job.pack_scale, job.proxy_level)
+    return '%08x' %(zlib.crc32(repr(settings).encode('ascii')))
 
-            if r > curve_maxval: curve_maxval = r
-            if r < curve_minval: curve_minval = r
 
-    del bands
+def product_asset_path(job, product):
+    # .blend file of a product, named after the settings it was built with
+    return os.path.join(job.data_dir, ASSET_CACHE_DIR, '%s-%s.blend' %(product.id, product_settings_key(job)))
 
-    pixels = [chan for px in pixels for chan in px]
-    pngname = FileAndExt[0] + '.PNG'
 
-    # modify scene for png export
-    scene = bpy.data.scenes[0]
-    settings = scene.render.image_settings
-    settings.color_depth = '16'
-    settings.color_mode = 'BW'
-    settings.file_format = 'PNG'
+def find_product_object(product_id):
+    # Mesh object of an earlier import of product_id that is still in a collection, or None.
+    # Imported meshes carry the id and settings key in their navcam_id and navcam_settings properties.
+    for ob in bpy.data.objects:
+        if ob.type == 'MESH' and ob.get('navcam_id') == product_id and len(ob.users_collection) > 0:
+            return ob
+    return None
 
-    image = bpy.data.images.new(os.path.basename(FileAndExt[0]), LINES, LINE_SAMPLES, float_buffer=True)
-    image.pixels = pixels
-    image.file_format = 'PNG'
-    image.save_render(pngname)
 
-    settings.color_depth = '8'
-    settings.color_mode = 'RGBA'
+def product_camera(ob):
+    # camera object added with the mesh object ob of a product, None when it is gone or ob was
+    # imported before cameras were recorded
+    cam_ob = bpy.data.objects.get(ob.get('navcam_camera', ''))
+    if cam_ob is not None and cam_ob.type == 'CAMERA':
+        return cam_ob
+    return None
 
-    # remove converted image from Blender, it will be reloaded
-    bpy.data.images.remove(image)
-    del pixels
 
-    return pngname
+def write_product_asset(filename, objects):
+    # Write objects (None entries are skipped), their children (the caption) and everything they
+    # use to filename. Textures that are not packed keep absolute paths, so the file can be
+    # appended from any scene.
+    objects = [ob for ob in objects if ob is not None]
+    datablocks = set(objects)
+    for ob in objects:
+        datablocks.update(ob.children)
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    partfile = filename + '.part'
+    bpy.data.libraries.write(partfile, datablocks, path_remap='ABSOLUTE')
+    os.replace(partfile, filename)
+    print('Product written to .blend cache: ', filename)
+
+
+def load_product_asset(filename, collection):
+    # Append the objects of a cached product to collection. Returns the mesh object, None when
+    # the product is not cached.
+    if not os.path.isfile(filename):
+        return None
+
+    print('Loading product from .blend cache: ', filename)
+    with bpy.data.libraries.load(filename, link=False) as (data_from, data_to):
+        data_to.objects = data_from.objects
+
+    mesh_ob = None
+    cam_ob = None
+    for ob in data_to.objects:
+        collection.objects.link(ob)
+        if ob.type == 'MESH':
+            mesh_ob = ob
+        elif ob.type == 'CAMERA':
+            cam_ob = ob
+            bpy.context.scene.camera = ob
+    if mesh_ob is not None and cam_ob is not None:
+        # appending may have renamed the camera
+        mesh_ob['navcam_camera'] = cam_ob.name
+    return mesh_ob
+
+
+# -----------------------------------------------------------------------------
+# Volume index catalog: the INDEX.TAB tables of the PDS volumes, stored in SQLite
+
+CATALOG_NAME = 'catalog.sqlite'
+CATALOG_MAX_AGE = 7 * 24 * 3600  # seconds before the volume indexes are revalidated
+CATALOG_TIMEOUT = 60  # seconds an index download may stall
+
+# index table (without extension) per volume, both relative to pdsimg_path
+CATALOG_VOLUMES = {
+    'mer/mer1no_0xxx/': 'index/index',
+    'mer/mer1po_0xxx/': 'index/index',
+    'mer/mer1ho_0xxx/': 'index/index',
+    'mer/mer2no_0xxx/': 'index/index',
+    'mer/mer2po_0xxx/': 'index/index',
+    'mer/mer2ho_0xxx/': 'index/index',
+    'msl/MSLNAV_1XXX/': 'INDEX/INDEX',
+}
+
+
+def product_id_fields(product_id):
+    # (rover, camera, eye, product type) encoded in a product id, None if not recognized
+    pid = product_id.upper()
+
+    entry = CAMERA_TABLE.get(pid[:2]) or CAMERA_TABLE.get(pid[:1])
+    if entry is None or len(pid) != ID_LENGTH[entry[0]]:
+        return None
+
+    rover, camera = entry[:2]
+    if rover == CURIOSITY:
+        return rover, camera, pid[1], pid[13:16]
+    return rover, camera, pid[23], pid[11:14]
+
+
+def open_catalog(data_dir):
+    os.makedirs(data_dir, exist_ok=True)
+
+    db = sqlite3.connect(os.path.join(data_dir, CATALOG_NAME), check_same_thread=False)
+    db.executescript('''
+        CREATE TABLE IF NOT EXISTS products (
+            product_id TEXT PRIMARY KEY, rover INTEGER, sol INTEGER, camera TEXT, eye TEXT,
+            sequence TEXT, product_type TEXT, volume TEXT, path TEXT);
+        CREATE INDEX IF NOT EXISTS products_rover ON products (rover);
+        CREATE INDEX IF NOT EXISTS products_sol ON products (sol);
+        CREATE INDEX IF NOT EXISTS products_camera ON products (camera);
+        CREATE INDEX IF NOT EXISTS products_sequence ON products (sequence);
+        CREATE INDEX IF NOT EXISTS products_type ON products (product_type);
+        CREATE TABLE IF NOT EXISTS indexes (
+            volume TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, length INTEGER, checked REAL);
+    ''')
+    return db
+
+
+def parse_index_label(lines):
+    # column name, start byte (1 based) and width from the INDEX.LBL description of INDEX.TAB
+    columns = []
+    column = None
+    for line in lines:
+        tmp = line.split("=")
+        if len(tmp) < 2:
+            continue
+        key = tmp[0].strip()
+        value = tmp[1].strip().strip('"')
+
+        if key == "OBJECT" and value == "COLUMN":
+            column = {}
+        elif key == "END_OBJECT" and value == "COLUMN":
+            if 'NAME' in column and 'START_BYTE' in column:
+                columns.append((column['NAME'], int(column['START_BYTE']), int(column['BYTES'])))
+            column = None
+        elif column is not None and key in ('NAME', 'START_BYTE', 'BYTES'):
+            column[key] = value
+
+    return columns
+
+
+def parse_index_rows(lines, columns):
+    for line in lines:
+        if len(line.strip()) == 0:
+            continue
+        row = {}
+        for name, start, width in columns:
+            row[name] = line[start - 1:start - 1 + width].strip().strip('"').strip()
+        yield row
+
+
+def ingest_index_rows(db, volume, rows):
+    records = []
+    for row in rows:
+        product_id = row.get('PRODUCT_ID', '').upper()
+        fields = product_id_fields(product_id)
+        if fields is None:
+            continue
+
+        path = row.get('FILE_SPECIFICATION_NAME')
+        if not path:
+            path = row.get('PATH_NAME', '') + row.get('FILE_NAME', '')
+
+        try:
+            sol = int(row.get('PLANET_DAY_NUMBER', ''))
+        except ValueError:
+            sol = tosol(fields[0], product_id)
+
+        records.append((product_id, fields[0], sol, fields[1], fields[2],
+                        row.get('SEQUENCE_ID', ''), fields[3], volume, path))
+
+    db.executemany('INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', records)
+    return len(records)
+
+
+def refresh_catalog_volume(db, data_dir, volume, max_age=CATALOG_MAX_AGE):
+    # Revalidate one volume index. An unchanged table costs a single 304 response, a changed one
+    # (new sols, reprocessed products) is downloaded again whole and replaces the volume's rows.
+    # Both files go through the cache directory like any product, so an interrupted download
+    # never leaves a truncated label or table behind.
+    state = db.execute('SELECT etag, last_modified, checked FROM indexes WHERE volume = ?', (volume,)).fetchone()
+    etag, last_modified, checked = state if state else (None, None, 0.0)
+
+    if state and time.time() - checked < max_age:
+        return 0
+
+    index_base = os.path.join(os.path.dirname(pdsimg_path), volume, CATALOG_VOLUMES[volume])
+    lbl_ext, tab_ext = ('.LBL', '.TAB') if CATALOG_VOLUMES[volume].isupper() else ('.lbl', '.tab')
+    local_base = os.path.join(data_dir, volume, CATALOG_VOLUMES[volume])
+    os.makedirs(os.path.dirname(local_base), exist_ok=True)
+
+    local_lbl = local_base + lbl_ext
+    if not os.path.isfile(local_lbl):
+        status, response, mirror = fetch_with_failover(index_base + lbl_ext, local_lbl, timeout=CATALOG_TIMEOUT)
+        if status != 200:
+            print('Cannot retrieve index label %s: %s' %(index_base + lbl_ext, status))
+            return 0
+
+    with open(local_lbl, 'r', errors='replace') as f:
+        columns = parse_index_label(f)
+
+    local_tab = local_base + tab_ext
+    headers = {}
+    meta = {}
+    if state and os.path.isfile(local_tab):
+        meta = read_validators(local_tab)
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+    status, response, mirror = fetch_with_failover(index_base + tab_ext, local_tab, headers,
+                                                   meta.get('mirror'), CATALOG_TIMEOUT)
+    if status == 304:
+        # index unchanged
+        db.execute('UPDATE indexes SET checked = ? WHERE volume = ?', (time.time(), volume))
+        db.commit()
+        return 0
+    if status != 200:
+        print('Cannot retrieve index table %s: %s' %(index_base + tab_ext, status))
+        return 0
+    write_validators(local_tab, index_base + tab_ext, response, mirror)
+
+    print('Updating catalog from %s' %(index_base + tab_ext))
+    db.execute('DELETE FROM products WHERE volume = ?', (volume,))
+
+    count = 0
+    pending = b''
+    with open(local_tab, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            pending = pending + chunk
+            # only complete rows are ingested, the remainder is kept for the next chunk
+            cut = pending.rfind(b'\n') + 1
+            lines = pending[:cut].decode('ascii', errors='replace').splitlines()
+            count = count + ingest_index_rows(db, volume, parse_index_rows(lines, columns))
+            pending = pending[cut:]
+    if pending:
+        count = count + ingest_index_rows(db, volume, parse_index_rows([pending.decode('ascii', errors='replace')], columns))
+
+    db.execute('INSERT OR REPLACE INTO indexes VALUES (?, ?, ?, ?, ?)',
+               (volume, response.get('etag'), response.get('last-modified'), os.path.getsize(local_tab), time.time()))
+    db.commit()
+
+    print('Catalog: %d products added from %s' %(count, volume))
+    return count
+
+
+def refresh_catalog(data_dir, volumes=None, max_age=CATALOG_MAX_AGE):
+    db = open_catalog(data_dir)
+    for volume in volumes or CATALOG_VOLUMES.keys():
+        refresh_catalog_volume(db, data_dir, volume, max_age)
+    return db
+
+
+def catalog_query(db, rover=None, sol=None, camera=None, eye=None, product_type=None, sequence=None):
+    # e.g. all left Navcam XYZ products of sol 1051:
+    # catalog_query(db, rover=CURIOSITY, sol=1051, camera='navcam', eye='L', product_type='XYZ')
+    clauses = []
+    params = []
+    for column, value in (('rover', rover), ('sol', sol), ('camera', camera), ('eye', eye),
+                          ('product_type', product_type), ('sequence', sequence)):
+        if value is not None:
+            clauses.append('%s = ?' %(column))
+            params.append(value.upper() if column in ('eye', 'product_type', 'sequence') else value)
+
+    sql = 'SELECT product_id, rover, sol, camera, eye, sequence, product_type, volume, path FROM products'
+    if clauses:
+        sql = sql + ' WHERE ' + ' AND '.join(clauses)
+
+    keys = ('product_id', 'rover', 'sol', 'camera', 'eye', 'sequence', 'product_type', 'volume', 'path')
+    return [dict(zip(keys, row)) for row in db.execute(sql + ' ORDER BY product_id', params)]
+
+
+def catalog_remote(job, filename, remotefile):
+    # remote url of a data product: the catalogued path when the job uses the volume catalog,
+    # None when the catalog rules the product out
+    if job.catalog is None:
+        return remotefile
+
+    with job.catalog_lock:
+        catalog_file = catalog_lookup(job.catalog, filename)
+    if catalog_file is False:
+        return None
+    return catalog_file or remotefile
+
+
+def catalog_lookup(db, filename):
+    # Remote url of a product file. Returns None when the catalog does not cover the product's
+    # volume, and False when the volume is covered but the product is not in it.
+    product_id = os.path.splitext(os.path.basename(filename))[0].upper()
+    row = db.execute('SELECT volume, path, rover FROM products WHERE product_id = ?', (product_id,)).fetchone()
+    if row:
+        # same case mapping as data_paths(): the MER archive is lower case, the index tables are not
+        path = row[1] if row[2] == CURIOSITY else row[1].lower()
+        return os.path.join(os.path.dirname(pdsimg_path), row[0], path)
+
+    fields = product_id_fields(product_id)
+    if fields is None:
+        return None
+    covered = db.execute('SELECT 1 FROM products WHERE rover = ? AND camera = ? LIMIT 1', (fields[0], fields[1])).fetchone()
+    if covered:
+        return False
+    return None
 
 
 # -----------------------------------------------------------------------------
@@ -795,8 +1945,9 @@ def create_cycles_texnode(context, node_tree, image):
     return tex_image
 
 
-def create_cycles_material(context, image):
-    global curve_minval, curve_maxval
+def create_cycles_material(context, image, curve=(0.0, 1.0), shading=False):
+    # curve: (min, max) range of the texture values, stretched to the full range by the curves node
+    # shading: multiply in the baked NAV_AO color attribute, see grid_occlusion()
 
     name_compat = bpy.path.display_name_from_filepath(image.filepath)
     material = None
@@ -812,9 +1963,9 @@ def create_cycles_material(context, image):
     core_shader = get_shadeless_node(node_tree)
 
     curvenode = node_tree.nodes.new('ShaderNodeRGBCurve')
-    curvenode.mapping.curves[3].points[0].location.x = curve_minval
+    curvenode.mapping.curves[3].points[0].location.x = curve[0]
     curvenode.mapping.curves[3].points[0].location.y = 0.0
-    curvenode.mapping.curves[3].points[1].location.x = curve_maxval
+    curvenode.mapping.curves[3].points[1].location.x = curve[1]
     curvenode.mapping.curves[3].points[1].location.y = 1.0
     curvenode.mapping.update()
 
@@ -822,7 +1973,18 @@ def create_cycles_material(context, image):
     node_tree.links.new(curvenode.inputs[1], tex_image.outputs[0])
 
     #Connect color from curves to shadeless
-    node_tree.links.new(core_shader.inputs[0], curvenode.outputs[0])
+    if shading:
+        ao_node = node_tree.nodes.new('ShaderNodeAttribute')
+        ao_node.attribute_name = 'NAV_AO'
+
+        multiply = node_tree.nodes.new('ShaderNodeMixRGB')
+        multiply.blend_type = 'MULTIPLY'
+        multiply.inputs[0].default_value = 1.0
+        node_tree.links.new(multiply.inputs[1], curvenode.outputs[0])
+        node_tree.links.new(multiply.inputs[2], ao_node.outputs['Color'])
+        node_tree.links.new(core_shader.inputs[0], multiply.outputs[0])
+    else:
+        node_tree.links.new(core_shader.inputs[0], curvenode.outputs[0])
     node_tree.links.new(out_node.inputs[0], core_shader.outputs[0])
 
     auto_align_nodes(node_tree)
@@ -867,260 +2029,860 @@ def get_collection(name):
         return bpy.data.collections.get(name)
 
 
-def create_mesh_from_depthimage(rover, sol, image_depth_filename, image_texture_filename, do_fill, do_rad):
-    # snippets used from:
-    # https://svn.blender.org/svnroot/bf-extensions/contrib/py/scripts/addons/io_import_LRO_Lola_MGS_Mola_img.py
-    # https://arsf-dan.nerc.ac.uk/trac/attachment/wiki/Processing/SyntheticDataset/data_handler.py
-
-    global curve_minval, curve_maxval
-
-    bRoverVec = Vector((0.0, 0.0, 0.0))
-
-    if image_depth_filename == '':
-        return
-
-    creation_date = None
-    LINES = LINE_SAMPLES = SAMPLE_BITS = 0
-    SAMPLE_TYPE = ""
-
-    FileAndPath = image_depth_filename
-    FileAndExt = os.path.splitext(FileAndPath)
-
-    print('Creating mesh...')
-
-    # Open the img label file (ascii label part)
-    try:
-        if FileAndExt[1].isupper():
-            f = open(FileAndExt[0] + ".IMG", 'r')
-        else:
-            f = open(FileAndExt[0] + ".img", 'r')
-    except:
-        return
+def parse_pds_label(lines):
+    """Parse the keys used by the decoders from the lines of a PDS label"""
+    label = {'LINES': 0, 'LINE_SAMPLES': 0, 'BANDS': 1, 'SAMPLE_BITS': 0, 'SAMPLE_TYPE': '',
+             'BYTES': 0, 'START_TIME': None, 'ORIGIN_OFFSET_VECTOR': None,
+             'ORIGIN_ROTATION_QUATERNION': None, 'SITE': None, 'XYZ_FRAME': None,
+             'RECORD_BYTES': 0, 'FILE_RECORDS': 0}
 
     block = ""
-    OFFSET = 0
-    for line in f:
+    for line in lines:
         if line.strip() == "END":
             break
+        if line.startswith("/*"):
+            continue
         tmp = line.split("=")
-        if tmp[0].strip() == "OBJECT" and tmp[1].strip() == "IMAGE":
+        if len(tmp) < 2:
+            continue
+        key = tmp[0].strip()
+        value = tmp[1].strip()
+
+        if key == "OBJECT" and value == "IMAGE":
             block = "IMAGE"
-        elif tmp[0].strip() == "END_OBJECT" and tmp[1].strip() == "IMAGE":
+        elif key == "END_OBJECT" and value == "IMAGE":
             block = ""
-        if tmp[0].strip() == "OBJECT" and tmp[1].strip() == "IMAGE_HEADER":
+        if key == "OBJECT" and value == "IMAGE_HEADER":
             block = "IMAGE_HEADER"
-        elif tmp[0].strip() == "END_OBJECT" and tmp[1].strip() == "IMAGE_HEADER":
+        elif key == "END_OBJECT" and value == "IMAGE_HEADER":
             block = ""
-        if tmp[0].strip() == "GROUP" and tmp[1].strip() == "ROVER_COORDINATE_SYSTEM":
+        if key == "GROUP" and value == "ROVER_COORDINATE_SYSTEM":
             block = "ROVER_COORDINATE_SYSTEM"
-        elif tmp[0].strip() == "END_GROUP" and tmp[1].strip() == "ROVER_COORDINATE_SYSTEM":
+        elif key == "END_GROUP" and value == "ROVER_COORDINATE_SYSTEM":
+            block = ""
+        if key == "GROUP" and value == "DERIVED_IMAGE_PARMS":
+            block = "DERIVED_IMAGE_PARMS"
+        elif key == "END_GROUP" and value == "DERIVED_IMAGE_PARMS":
             block = ""
 
-        elif tmp[0].strip() == "START_TIME":
-            creation_date = str(tmp[1].strip())
+        elif key == "START_TIME":
+            label['START_TIME'] = str(value)
+        elif key in ("RECORD_BYTES", "FILE_RECORDS") and block == "":
+            label[key] = int(value)
 
         if block == "IMAGE":
-            if line.find("LINES") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                LINES = int(tmp[1].strip())
-            elif line.find("LINE_SAMPLES") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                LINE_SAMPLES = int(tmp[1].strip())
-            elif line.find("SAMPLE_TYPE") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                SAMPLE_TYPE = tmp[1].strip()
-            elif line.find("SAMPLE_BITS") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                SAMPLE_BITS = int(tmp[1].strip())
+            if key in ("LINES", "LINE_SAMPLES", "BANDS", "SAMPLE_BITS"):
+                label[key] = int(value)
+            elif key == "SAMPLE_TYPE":
+                label[key] = value
 
         if block == "IMAGE_HEADER":
-            if line.find("BYTES") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                BYTES = int(tmp[1].strip())
+            if key == "BYTES":
+                label[key] = int(value)
 
         if block == "ROVER_COORDINATE_SYSTEM":
-            if line.find("ORIGIN_OFFSET_VECTOR") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                ORIGIN_OFFSET_VECTOR = str(tmp[1].strip())
-
-                fline = re.sub('[(!@#$)]', '', ORIGIN_OFFSET_VECTOR)
+            if key == "ORIGIN_OFFSET_VECTOR":
+                fline = re.sub('[(!@#$)]', '', value)
                 pf = fline.strip().split(",")
+                label[key] = (float(pf[0]), float(pf[1]), float(pf[2]))
+            elif key == "ORIGIN_ROTATION_QUATERNION":
+                pf = re.sub('[()]', '', value).split(",")
+                if len(pf) == 4:
+                    label[key] = tuple(float(q) for q in pf)
+            elif key == "REFERENCE_COORD_SYSTEM_INDEX":
+                site = re.findall(r'\d+', value)
+                if site:
+                    label['SITE'] = int(site[0])
+
+        if block == "DERIVED_IMAGE_PARMS":
+            if key == "REFERENCE_COORD_SYSTEM_NAME":
+                label['XYZ_FRAME'] = value.strip('"')
 
-                bRoverVec[:] = float(pf[1]), float(pf[0]), -float(pf[2])
+    return label
 
-    f.close
 
-    # Open the img label file (binary data part)
+def read_pds_label(FileAndPath):
     try:
-        if FileAndExt[1].isupper():
-            f2 = open(FileAndExt[0] + ".IMG", 'rb')
-        else:
-            f2 = open(FileAndExt[0] + ".img", 'rb')
-    except:
-        return
+        with open(FileAndPath, 'r', errors='replace') as f:
+            return parse_pds_label(f)
+    except IOError:
+        return None
 
-    edit = f2.read()
-    meh = edit.find(b'LBLSIZE')
-    f2.seek( meh + BYTES)
 
-    # Create a list of bands containing an empty list for each band.
-    # Each band contains a sequence of Float32 IEEE754 (4 bytes); byte order is specified in PDS label and Vicar label   
-    # at the beginning of the file.	   
+def find_image_offset(f2, header_bytes):
+    # the image data starts right after the VICAR header that follows the PDS label;
+    # scan for it in chunks rather than reading the whole product into memory
+    f2.seek(0)
+    pos = 0
+    tail = b''
+    while True:
+        chunk = f2.read(65536)
+        if not chunk:
+            return None
+        buf = tail + chunk
+        meh = buf.find(b'LBLSIZE')
+        if meh != -1:
+            return pos - len(tail) + meh + header_bytes
+        tail = buf[-6:]
+        pos = pos + len(chunk)
+
+
+def sample_dtype(label):
+    # PC_REAL products are little endian, IEEE_REAL (the usual case) is big endian
+    if label['SAMPLE_TYPE'].startswith('PC_'):
+        return np.dtype('<f4')
+    return np.dtype('>f4')
+
+
+def decode_memory(LINES, LINE_SAMPLES, ranged=False, normals=False):
+    # Peak memory of a product apart from the read blocks. Per sample: the float32 grid (12 bytes),
+    # validity mask, face indices (16 bytes) and uvs. ranged adds the camera distance of Max Range,
+    # Detail Range and point clouds (difference, its square and the distance, 28 bytes), normals
+    # the temporaries of grid_normals() and grid_occlusion() (64 bytes).
+    per_sample = 12 + 1 + 16 + 8
+    if ranged:
+        per_sample = per_sample + 28
+    if normals:
+        per_sample = per_sample + 64
+    return LINES * LINE_SAMPLES * per_sample
+
+
+def block_rows_for_limit(LINES, LINE_SAMPLES, memory_limit, ranged=False, normals=False):
+    # Rows read and meshed per block: whatever memory_limit leaves after the whole product grid and
+    # its temporaries, which are always allocated. A limit below those only shrinks the blocks to
+    # a single row, it cannot keep the product within the limit.
+    fixed = decode_memory(LINES, LINE_SAMPLES, ranged, normals)
+    # per decoded row: raw band buffers plus their float copies
+    per_row = LINE_SAMPLES * 3 * 4 * 3
+    budget = memory_limit * 1024 * 1024 - fixed
+
+    if budget < per_row:
+        print('Memory limit of %d MB is below the %d MB needed for this product, decoding row by row' %(memory_limit, fixed // (1024 * 1024)))
+        return 1
+
+    return int(max(1, min(LINES, budget // per_row)))
+
+
+def decode_depthimage(image_depth_filename, label, do_fill, block_rows):
+    # Each band contains a sequence of Float32 IEEE754 (4 bytes); byte order is specified in PDS label and Vicar label
+    # at the beginning of the file.
     # Band 0 = X, Band 1 = Y, Band 2 = Z.
-    # Band length = bytes_per_sample * lines * samples	= 4 * lines * samples
-	   
-    bands = []
+    # Band length = bytes_per_sample * lines * samples = 4 * lines * samples
+    # The bands are read in blocks of block_rows rows so only one block of raw data is held at a
+    # time, see block_rows_for_limit().
+
+    LINES = label['LINES']
+    LINE_SAMPLES = label['LINE_SAMPLES']
+    dtype = sample_dtype(label)
+    row_bytes = LINE_SAMPLES * 4
+    band_bytes = LINES * row_bytes
 
-    # Read data for each band at a time
-    for bandnum in range(0, 3):
-        bands.append([])
+    grid = np.zeros((LINES, LINE_SAMPLES, 3), dtype=np.float32)
 
-        for linenum in range(0, LINES):
+    #simple dehole (bridge), state carried across row blocks
+    max_fill_length = 0.6
+    last_row = np.full(LINE_SAMPLES, -1, dtype=np.int64)
+    last_vec = np.zeros((LINE_SAMPLES, 3), dtype=np.float32)
+
+    with open(image_depth_filename, 'rb') as f2:
+        offset = find_image_offset(f2, label['BYTES'])
+        if offset is None:
+            print('ERROR, no VICAR header found in ', image_depth_filename)
+            return None
+
+        for r0 in range(0, LINES, block_rows):
+            r1 = min(LINES, r0 + block_rows)
+            count = (r1 - r0) * LINE_SAMPLES
+
+            block = []
+            for bandnum in range(0, 3):
+                f2.seek(offset + bandnum * band_bytes + r0 * row_bytes)
+                data = np.fromfile(f2, dtype=dtype, count=count)
+                if data.size != count:
+                    print ('ERROR, Ran out of data to read before we should have')
+                    return None
+                block.append(data.reshape(r1 - r0, LINE_SAMPLES))
+
+            # Rover Z axis points downwards, hence invert Z
+            grid[r0:r1, :, 0] = block[1] * 0.1
+            grid[r0:r1, :, 1] = block[0] * 0.1
+            grid[r0:r1, :, 2] = block[2] * -0.1
+            del block
+
+            if not do_fill:
+                continue
+
+            for j in range(r0, r1):
+                row = grid[j]
+                valid = np.any(row != 0.0, axis=1)
+                gap = valid & (last_row >= 0) & (last_row < j - 1)
+
+                if gap.any():
+                    cols = np.nonzero(gap)[0]
+                    vec_a = last_vec[cols]
+                    vec_b = row[cols]
+                    close = np.linalg.norm(vec_b - vec_a, axis=1) < max_fill_length
+
+                    for k, va, vb in zip(cols[close], vec_a[close], vec_b[close]):
+                        m = j - last_row[k]
+                        t = (np.arange(1, m, dtype=np.float32) / m)[:, None]
+                        grid[last_row[k] + 1:j, k] = va + (vb - va) * t
+
+                last_row[valid] = j
+                last_vec[valid] = row[valid]
+
+    return grid
+
+
+def camera_eye(label):
+    # approximate camera position in the frame of the xyz data, in Blender axes and scale: the rover
+    # origin raised to mast height
+    eye = np.array([0.0, 0.0, 0.15])
+    if label['XYZ_FRAME'] != 'ROVER_FRAME' and label['ORIGIN_OFFSET_VECTOR'] is not None:
+        pf = label['ORIGIN_OFFSET_VECTOR']
+        eye = eye + np.array([pf[1], pf[0], -pf[2]]) * 0.1
+    return eye
+
+
+def stretched_quads(a, b, c, d, eye, max_stretch):
+    # True for quads (given by their corner arrays) with an edge longer than max_stretch times the
+    # distance of their nearest corner to the camera. Those bridge a depth discontinuity, such as a
+    # rock in front of distant terrain, or lie almost along the line of sight.
+    edge = np.linalg.norm(b - a, axis=-1)
+    for p, q in ((b, c), (c, d), (d, a)):
+        edge = np.maximum(edge, np.linalg.norm(q - p, axis=-1))
+
+    distance = np.linalg.norm(a - eye, axis=-1)
+    for p in (b, c, d):
+        distance = np.minimum(distance, np.linalg.norm(p - eye, axis=-1))
+
+    return edge > max_stretch * distance
+
+
+# coarsest grid stride used for distant rows, see row_strides()
+MAX_STRIDE_LEVEL = 3
+
+
+def row_strides(distance, valid, detail_range):
+    # Grid stride for the quads starting at every row: 1 for rows with a sample closer than
+    # detail_range (in Blender units), doubling with every doubling of the distance of the nearest
+    # sample of the row, up to 2 ** MAX_STRIDE_LEVEL
+    LINES = distance.shape[0]
+    if detail_range <= 0:
+        return np.ones(LINES, dtype=np.int64)
+
+    nearest = np.where(valid, distance, np.inf).min(axis=1)
+    with np.errstate(divide='ignore'):
+        level = np.floor(np.log2(nearest / detail_range)) + 1
+    level = np.clip(np.nan_to_num(level, posinf=MAX_STRIDE_LEVEL), 0, MAX_STRIDE_LEVEL)
+    return np.power(2, level).astype(np.int64)
+
+
+def stride_runs(strides, LINES):
+    # Split the rows into runs of (first row, last row, stride). A run starts on a multiple of its
+    # stride, so the rows of a coarse run are a subset of the rows a finer run would use.
+    steps = []
+    r = 0
+    while r < LINES - 1:
+        stride = int(strides[r])
+        while stride > 1 and (r % stride or r + stride > LINES - 1 or strides[r:r + stride].min() < stride):
+            stride = stride // 2
+        steps.append((r, stride))
+        r = r + stride
+
+    runs = []
+    for r, stride in steps:
+        if runs and runs[-1][2] == stride:
+            runs[-1][1] = r + stride
+        else:
+            runs.append([r, r + stride, stride])
+    return runs
+
+
+def snap_run_borders(grid, valid, runs):
+    # Where a fine run meets a coarse run, move the samples of the shared row that only the fine run
+    # uses onto the edges of the coarse quads, so the two resolutions meet without cracks
+    LINE_SAMPLES = grid.shape[1]
+
+    for (a0, row, fine), (b0, b1, coarse) in zip(runs, runs[1:]):
+        if fine > coarse:
+            fine, coarse = coarse, fine
+
+        cols = np.arange(fine, LINE_SAMPLES, fine)
+        cols = cols[(cols % coarse != 0) & (cols - cols % coarse + coarse <= LINE_SAMPLES - 1)]
+        c0 = cols - cols % coarse
+        c1 = c0 + coarse
+
+        snap = valid[row, c0] & valid[row, c1]
+        t = ((cols - c0) / coarse)[:, None]
+        grid[row, cols[snap]] = (grid[row, c0] * (1 - t) + grid[row, c1] * t)[snap]
+
+
+def triangulate_quads(verts, faces):
+    # split every quad along its shorter diagonal, so the mesh does not depend on how Blender
+    # would split the (usually non-planar) quads at render time
+    diagonal_02 = ((verts[faces[:, 2]] - verts[faces[:, 0]]) ** 2).sum(axis=1)
+    diagonal_13 = ((verts[faces[:, 3]] - verts[faces[:, 1]]) ** 2).sum(axis=1)
+    split_02 = (diagonal_02 <= diagonal_13)[:, None]
+
+    first = np.where(split_02, faces[:, [0, 1, 2]], faces[:, [0, 1, 3]])
+    second = np.where(split_02, faces[:, [0, 2, 3]], faces[:, [1, 2, 3]])
+    return np.stack((first, second), axis=1).reshape(-1, 3)
+
+
+def build_grid_faces(grid, block_rows, eye=None, max_stretch=0.0, max_range=0.0, detail_range=0.0, triangulate=False):
+    # Emit quads between grid neighbours, one block of rows at a time. Quads touching a sample without
+    # xyz data are skipped, as are quads stretched across a depth discontinuity when max_stretch is
+    # set; after which unused samples are dropped and indices compacted.
+    # max_range drops samples further from the camera, and with detail_range set distant rows are
+    # meshed with a coarser stride (ranges in meters, 0 = off). With triangulate, the quads are
+    # returned as triangles.
+    LINES, LINE_SAMPLES = grid.shape[:2]
+    valid = np.any(grid != 0.0, axis=2)
+
+    if eye is None:
+        eye = np.zeros(3)
+    if max_range > 0 or detail_range > 0:
+        distance = np.linalg.norm(grid - np.asarray(eye, dtype=np.float32), axis=2)
+        if max_range > 0:
+            valid &= distance <= max_range * 0.1
+        runs = stride_runs(row_strides(distance, valid, detail_range * 0.1), LINES)
+        del distance
+        snap_run_borders(grid, valid, runs)
+    else:
+        runs = [[0, LINES - 1, 1]]
 
-            bands[bandnum].append([])
+    face_blocks = []
 
-            for pixnum in range(0, LINE_SAMPLES):
+    for run0, run1, step in runs:
+        cols = np.arange(0, LINE_SAMPLES - step, step)
+        c0 = slice(0, LINE_SAMPLES - step, step)
+        c1 = slice(step, LINE_SAMPLES, step)
 
-                # Read one data item (pixel) from the data file.
-                dataitem = f2.read(4)
+        for r0 in range(run0, run1, block_rows * step):
+            r1 = min(run1, r0 + block_rows * step)
+            rows = np.arange(r0, r1, step)[:, None]
+            top = slice(r0, r1, step)
+            bottom = slice(r0 + step, r1 + step, step)
 
-                if (dataitem == ""):
-                    print ('ERROR, Ran out of data to read before we should have')
+            keep = valid[top, c0] & valid[top, c1] & valid[bottom, c1] & valid[bottom, c0]
+            if max_stretch > 0:
+                keep &= ~stretched_quads(grid[top, c0], grid[top, c1], grid[bottom, c1],
+                                         grid[bottom, c0], eye, max_stretch * step)
+
+            v0 = rows * LINE_SAMPLES + cols
+            quads = np.stack((v0, v0 + step, v0 + step * LINE_SAMPLES + step, v0 + step * LINE_SAMPLES), axis=-1)
+            face_blocks.append(quads[keep].astype(np.int32))
 
-                # If everything worked, unpack the binary value and store it in the appropriate pixel value
-                bands[bandnum][linenum].append(struct.unpack('>f', dataitem)[0])
+    if face_blocks:
+        faces = np.concatenate(face_blocks)
+    else:
+        faces = np.zeros((0, 4), dtype=np.int32)
+    del face_blocks
 
-    f2.close
+    used = np.zeros(LINES * LINE_SAMPLES, dtype=bool)
+    used[faces.ravel()] = True
+    grid_index = np.nonzero(used)[0].astype(np.int32)
 
-    Vertex = []
-    Faces = []
+    remap = np.cumsum(used, dtype=np.int32) - 1
+    faces = remap[faces]
 
-    nulvec = Vector((0.0,0.0,0.0))
+    verts = grid.reshape(-1, 3)[grid_index]
 
-    for j in range(0, LINES):
-        for k in range(0, LINE_SAMPLES):
-            vec = Vector((float(bands[1][j][k]), float(bands[0][j][k]), float(-bands[2][j][k])))  # Rover Z axis points downwards, hence invert Z
-            vec = vec*0.1
-            Vertex.append(vec)
+    if triangulate:
+        faces = triangulate_quads(verts, faces)
 
-    del bands
+    return verts, faces, grid_index
 
-    #simple dehole (bridge)
-    #max_fill_length = fill_length
-    max_fill_length = 0.6
-    if(do_fill):
-        for j in range(0, LINES-1):
-            for k in range(0, LINE_SAMPLES-1):
-                if Vertex[j * LINE_SAMPLES + k] != nulvec:
-                    m = 1
-                    while Vertex[(j + m) * LINE_SAMPLES + k] == nulvec and (j + m) < LINES-1:
-                        m = m + 1
-
-                    if m != 1 and Vertex[(j + m) * LINE_SAMPLES + k] != nulvec:
-                        VertexA = Vertex[j * LINE_SAMPLES + k]
-                        VertexB = Vertex[(j + m) * LINE_SAMPLES + k]
-                        sparevec = VertexB - VertexA
-                        if sparevec.length < max_fill_length:
-                            for n in range(0, m):
-                                Vertex[(j + n) * LINE_SAMPLES + k] = VertexA + (sparevec / m) * n
-
-    for j in range(0, LINES-1):
-        for k in range(0, LINE_SAMPLES-1):
-            Faces.append(( (j * LINE_SAMPLES + k), (j * LINE_SAMPLES + k + 1), ((j + 1) * LINE_SAMPLES + k + 1), ((j + 1) * LINE_SAMPLES + k) ))
-
-    os.path.basename(FileAndExt[0])
-    TARGET_NAME = '%s-%s' %(sol, os.path.basename(FileAndExt[0]))
-    mesh = bpy.data.meshes.new(TARGET_NAME)
-    TARGET_NAME = mesh.name
-    mesh.from_pydata(Vertex, [], Faces)
-
-    del Vertex
-    del Faces
-    mesh.update()
 
-    print('Texturing mesh...')
+def grid_points(grid, eye, max_range=0.0):
+    # Point cloud counterpart of build_grid_faces(): every sample with xyz data (within max_range
+    # meters of the camera) becomes a vertex, no faces. Also returns the range of every point in meters.
+    valid = np.any(grid != 0.0, axis=2)
+    distance = np.linalg.norm(grid - np.asarray(eye, dtype=np.float32), axis=2)
+    if max_range > 0:
+        valid &= distance <= max_range * 0.1
 
-    ob_new = bpy.data.objects.new(TARGET_NAME, mesh)
-    ob_new.data = mesh
+    grid_index = np.nonzero(valid.ravel())[0].astype(np.int32)
+    verts = grid.reshape(-1, 3)[grid_index]
+    point_range = (distance.ravel()[grid_index] * 10.0).astype(np.float32)
 
-    theSolCollection = get_collection('Sol%s' %(sol))
-    theSolCollection.objects.link(ob_new)
-    ob_new.select_set(state=True)
-    bpy.context.view_layer.objects.active = ob_new
+    return verts, np.zeros((0, 4), dtype=np.int32), grid_index, point_range
+
+
+def shifted(grid, dr, dc):
+    # slices (target, source) pairing every grid position with its neighbour at (dr, dc), None
+    # when the offset reaches beyond the grid and no position has that neighbour
+    if abs(dr) >= grid.shape[0] or abs(dc) >= grid.shape[1]:
+        return None
+
+    def axis(d, n):
+        if d >= 0:
+            return slice(0, n - d), slice(d, n)
+        return slice(-d, n), slice(0, n + d)
+
+    (tr, sr), (tc, sc) = axis(dr, grid.shape[0]), axis(dc, grid.shape[1])
+    return (tr, tc), (sr, sc)
+
+
+# neighbour distances (in samples) searched for the horizon in every direction, see grid_occlusion()
+HORIZON_STEPS = (1, 2, 4, 8, 16)
+
+
+def grid_normals(grid):
+    # Per sample unit normals of an xyz grid from central differences along rows and columns,
+    # one-sided next to samples without xyz data, oriented like the faces of build_grid_faces()
+    valid = np.any(grid != 0.0, axis=2)
+
+    def neighbour(dr, dc):
+        # neighbour position at (dr, dc), the sample itself where there is none
+        result = grid.copy()
+        pairs = shifted(grid, dr, dc)
+        if pairs is None:
+            return result
+        (tr, tc), (sr, sc) = pairs
+        result[tr, tc] = np.where(valid[sr, sc][:, :, None], grid[sr, sc], grid[tr, tc])
+        return result
+
+    along_row = neighbour(0, 1) - neighbour(0, -1)
+    along_column = neighbour(1, 0) - neighbour(-1, 0)
+    normals = np.cross(along_row, along_column)
+    del along_row, along_column
+    length = np.linalg.norm(normals, axis=2)
+    up = np.array((0.0, 0.0, 1.0), dtype=np.float32)
+    return np.where(length[:, :, None] > 0, normals / np.maximum(length, 1e-12)[:, :, None], up)
+
+
+def grid_occlusion(grid):
+    # Horizon based ambient occlusion per sample of an xyz grid: in 8 grid directions the steepest
+    # elevation towards the neighbours at HORIZON_STEPS is found, and its sine averaged over the
+    # directions is the occluded fraction
+    valid = np.any(grid != 0.0, axis=2)
+
+    occlusion = np.zeros(grid.shape[:2], dtype=np.float32)
+    for dr, dc in ((0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1)):
+        horizon = np.zeros(grid.shape[:2], dtype=np.float32)
+        for step in HORIZON_STEPS:
+            pairs = shifted(grid, dr * step, dc * step)
+            if pairs is None:
+                break
+            (tr, tc), (sr, sc) = pairs
+            delta = grid[sr, sc] - grid[tr, tc]
+            elevation = delta[:, :, 2] / np.maximum(np.hypot(delta[:, :, 0], delta[:, :, 1]), 1e-6)
+            elevation = np.where(valid[sr, sc] & valid[tr, tc], elevation, 0.0)
+            horizon[tr, tc] = np.maximum(horizon[tr, tc], elevation)
+        occlusion += horizon / np.sqrt(1.0 + horizon * horizon)
+
+    return (1.0 - occlusion / 8.0).astype(np.float32)
+
+
+def shading_colors(values):
+    # RGBA per vertex: gray for scalars, 0.5 + 0.5 * n for normals
+    colors = np.ones((len(values), 4), dtype=np.float32)
+    if values.ndim == 1:
+        colors[:, :3] = values[:, None]
+    else:
+        colors[:, :3] = 0.5 + 0.5 * values
+    return colors
+
+
+def set_custom_normals(mesh, normals):
+    # smooth shading with the given normals, one per vertex or, shaped (faces, corners, 3), one per face corner
+    mesh.polygons.foreach_set('use_smooth', np.ones(len(mesh.polygons), dtype=bool))
+    if bpy.app.version < (4, 1, 0):
+        # custom normals are ignored without auto smooth before 4.1
+        mesh.use_auto_smooth = True
+    if normals.ndim == 3:
+        mesh.normals_split_custom_set(normals.reshape(-1, 3))
+    else:
+        mesh.normals_split_custom_set_from_vertices(normals)
+
+
+def set_color_attribute(mesh, name, colors, faces=None):
+    # With faces, colors holds one color per vertex. Since Blender 3.2 they are stored per point,
+    # vertex colors before that only exist per face corner and are expanded through faces.
+    # Without faces, colors is already per face corner (welded mosaics, where one vertex can carry
+    # different colors of the overlapping products); those are stored as 8 bit colors.
+    if hasattr(mesh, 'color_attributes'):
+        if faces is not None:
+            layer = mesh.color_attributes.new(name, 'FLOAT_COLOR', 'POINT')
+        else:
+            layer = mesh.color_attributes.new(name, 'BYTE_COLOR', 'CORNER')
+    else:
+        layer = mesh.vertex_colors.new(name=name)
+        if faces is not None:
+            colors = colors[faces]
+    layer.data.foreach_set('color', colors.ravel())
+
+
+def grid_uvs(grid_index, LINES, LINE_SAMPLES, crop=None):
+    # crop: (left, right, top, bottom) of a cropped texture as fractions of the full one
+    left, right, top, bottom = crop or (0.0, 1.0, 0.0, 1.0)
+    uv = np.empty((len(grid_index), 2), dtype=np.float32)
+    uv[:, 0] = ((grid_index % LINE_SAMPLES) * (1.0 / LINE_SAMPLES) - left) / (right - left)
+    uv[:, 1] = 1.0 - ((grid_index // LINE_SAMPLES) * (1.0 / LINES) - top) / (bottom - top)
+    return uv
 
-    obj = bpy.context.object
 
+def mesh_from_arrays(name, verts, faces):
+    # bulk upload of vertex and polygon data, faces is an (n, corners) index array
+    corners = faces.shape[1]
+
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(len(verts))
+    mesh.vertices.foreach_set('co', verts.ravel())
+
+    mesh.loops.add(faces.size)
+    mesh.loops.foreach_set('vertex_index', faces.ravel())
+
+    mesh.polygons.add(len(faces))
+    mesh.polygons.foreach_set('loop_start', np.arange(0, faces.size, corners, dtype=np.int32))
+    mesh.polygons.foreach_set('loop_total', np.full(len(faces), corners, dtype=np.int32))
+
+    mesh.update(calc_edges=True)
+    return mesh
+
+
+def center_on_origin(verts):
+    # Same result as origin_set(type='ORIGIN_GEOMETRY'): vertices relative to their median
+    # center, returned with the center to use as object location
+    if len(verts) == 0:
+        return verts, np.zeros(3, dtype=np.float32)
+    center = verts.mean(axis=0)
+    return (verts - center).astype(np.float32), center
+
+
+def rover_frame_matrix(label):
+    # Rotation (as 3x3 array) and offset of the rover frame in the site frame, in Blender axes and scale.
+    # PDS quaternions are (s, v1, v2, v3); Blender axes are (y, x, -z) of the rover axes, scaled by 0.1
+    s, a, b, c = label['ORIGIN_ROTATION_QUATERNION'] or (1.0, 0.0, 0.0, 0.0)
+    rot = np.array([[1 - 2*(b*b + c*c), 2*(a*b - s*c), 2*(a*c + s*b)],
+                    [2*(a*b + s*c), 1 - 2*(a*a + c*c), 2*(b*c - s*a)],
+                    [2*(a*c - s*b), 2*(b*c + s*a), 1 - 2*(a*a + b*b)]])
+
+    axes = np.array([[0.0, 1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, -1.0]])
+    offset = np.array(label['ORIGIN_OFFSET_VECTOR'] or (0.0, 0.0, 0.0))
+
+    return axes @ rot @ axes.T, (axes @ offset) * 0.1
+
+
+def load_depth_product(image_depth_filename, do_fill, memory_limit=DEFAULT_MEMORY_LIMIT, max_stretch=0.0,
+                       max_range=0.0, detail_range=0.0, triangulate=False, points=False, shading=False,
+                       smooth=False):
+    label = read_pds_label(image_depth_filename)
+    if label is None:
+        return None
+
+    LINES = label['LINES']
+    LINE_SAMPLES = label['LINE_SAMPLES']
+
+    block_rows = block_rows_for_limit(LINES, LINE_SAMPLES, memory_limit,
+                                      points or max_range > 0 or detail_range > 0, shading or smooth)
+    grid = decode_depthimage(image_depth_filename, label, do_fill, block_rows)
+    if grid is None:
+        return None
+
+    point_range = None
+    if points:
+        verts, faces, grid_index, point_range = grid_points(grid, camera_eye(label), max_range)
+    else:
+        verts, faces, grid_index = build_grid_faces(grid, block_rows, camera_eye(label), max_stretch,
+                                                    max_range, detail_range, triangulate)
+
+    normals = None
+    shading_values = None
+    if shading or smooth:
+        normals = grid_normals(grid).reshape(-1, 3)[grid_index]
+    if shading:
+        ao = grid_occlusion(grid).ravel()[grid_index]
+    del grid
+
+    # xyz is normally delivered in the site frame, products in the rover frame are placed
+    # with the rover position and attitude so all products of a site share one frame
+    if label['XYZ_FRAME'] == 'ROVER_FRAME':
+        rot, offset = rover_frame_matrix(label)
+        verts = (verts @ rot.T + offset).astype(np.float32)
+        if normals is not None:
+            normals = (normals @ rot.T).astype(np.float32)
+
+    if shading:
+        # slope in degrees from horizontal, as a fraction of 90
+        slope = np.degrees(np.arccos(np.clip(np.abs(normals[:, 2]), 0.0, 1.0))) / 90.0
+        shading_values = {'NAV_AO': ao, 'NAV_SLOPE': slope.astype(np.float32), 'NAV_NORMAL': normals}
+
+    bRoverVec = Vector((0.0, 0.0, 0.0))
+    if label['ORIGIN_OFFSET_VECTOR'] is not None:
+        pf = label['ORIGIN_OFFSET_VECTOR']
+        bRoverVec[:] = pf[1], pf[0], -pf[2]
+
+    return {'name': os.path.basename(os.path.splitext(image_depth_filename)[0]),
+            'label': label,
+            'verts': verts,
+            'faces': faces,
+            'grid_index': grid_index,
+            'range': point_range,
+            'shading': shading_values,
+            'normals': normals if smooth else None,
+            'rover_vec': bRoverVec}
+
+
+def product_center(depth):
+    # median center of the product geometry, as used for the object origin
+    if len(depth['verts']) == 0:
+        return Vector((0.0, 0.0, 0.0))
+    return Vector(depth['verts'].mean(axis=0))
+
+
+def pack_navcam_image(img):
+    # pack an imported texture, downscaled first when it was imported with a pack scale below 1
+    if img.packed_file is not None:
+        return
+    scale = img.get('navcam_pack_scale', 1.0)
+    try:
+        if scale < 1.0 and img.source != 'TILED':
+            width, height = img.size
+            img.scale(max(1, int(width * scale)), max(1, int(height * scale)))
+            try:
+                # the scaled buffer is packed as png; since Blender 2.92 pack() does that by itself
+                img.pack(as_png=True)
+            except TypeError:
+                img.pack()
+        else:
+            img.pack()
+    except RuntimeError:
+        # tiled images can only be packed since Blender 3.0
+        print('Texture %s is kept in %s' %(img.name, img.filepath))
+
+
+def pack_navcam_images(pack):
+    # pack the imported textures that were left for later by the given packing policy
+    for img in bpy.data.images:
+        if img.get('navcam_pack') == pack:
+            pack_navcam_image(img)
+
+
+@bpy.app.handlers.persistent
+def pack_navcam_images_on_save(dummy):
+    pack_navcam_images('SAVE')
+
+
+def mark_navcam_image(img, pack, pack_scale):
+    # the packing policy is kept on the image, so a save in a later session still applies it
+    img['navcam_pack'] = pack
+    img['navcam_pack_scale'] = pack_scale
+    if pack == 'NOW':
+        pack_navcam_image(img)
+
+
+def set_material_texture(material, image_name):
+    image = bpy.data.images.get(image_name)
+    if image is None or not material.use_nodes:
+        return
+    for node in material.node_tree.nodes:
+        if node.type == 'TEX_IMAGE':
+            node.image = image
+
+
+@bpy.app.handlers.persistent
+def use_full_textures(scene, *args):
+    # renders use the full textures of materials with a viewport proxy
+    for material in bpy.data.materials:
+        if 'navcam_full' in material:
+            set_material_texture(material, material['navcam_full'])
+
+
+@bpy.app.handlers.persistent
+def use_proxy_textures(scene, *args):
+    for material in bpy.data.materials:
+        if 'navcam_proxy' in material:
+            set_material_texture(material, material['navcam_proxy'])
+
+
+def load_texture_material(image_texture_filename, curve=(0.0, 1.0), pack='NOW', pack_scale=1.0, proxy_level=0, shading=False):
     try:
         with open(image_texture_filename):
             img = bpy.data.images.load(image_texture_filename)
-            img.pack()
+            mark_navcam_image(img, pack, pack_scale)
 
             engine = bpy.context.scene.render.engine
             if engine in {'CYCLES', 'BLENDER_EEVEE', 'BLENDER_OPENGL'}:
-                material = create_cycles_material(bpy.context, img)
+                material = create_cycles_material(bpy.context, img, curve, shading)
 
-            # add material to object
-            obj.data.materials.append(material)
+                proxyname = texture_proxy(image_texture_filename, proxy_level) if proxy_level > 0 else None
+                if proxyname is not None:
+                    proxy = bpy.data.images.load(proxyname)
+                    mark_navcam_image(proxy, pack, 1.0)
+                    material['navcam_full'] = img.name
+                    material['navcam_proxy'] = proxy.name
+                    set_material_texture(material, proxy.name)
 
-            me = obj.data
-            #me.show_double_sided = True
-            bpy.ops.mesh.uv_texture_add()
+                return material
 
     except IOError:
         print('Oh dear. Missing %s' %(image_texture_filename))
 
-    uvteller = 0
-
-    #per face !
-    for j in range(0, LINES -1):
-        for k in range(0, LINE_SAMPLES-1):
-            tc1 = Vector(((1.0 / LINE_SAMPLES) * k, 1.0 - (1.0 / LINES) * j))
-            tc2 = Vector(((1.0 / LINE_SAMPLES) * (k + 1), 1.0 - (1.0 / LINES) * j))
-            tc3 = Vector(((1.0 / LINE_SAMPLES) * (k + 1), 1.0 - (1.0 / LINES) * (j + 1)))
-            tc4 = Vector(((1.0 / LINE_SAMPLES) * k, 1.0 - (1.0 / LINES) * (j + 1)))
-
-            bpy.data.objects[TARGET_NAME].data.uv_layers[0].data[uvteller].uv = tc1
-            uvteller = uvteller + 1
-            bpy.data.objects[TARGET_NAME].data.uv_layers[0].data[uvteller].uv = tc2
-            uvteller = uvteller + 1
-            bpy.data.objects[TARGET_NAME].data.uv_layers[0].data[uvteller].uv = tc3
-            uvteller = uvteller + 1
-            bpy.data.objects[TARGET_NAME].data.uv_layers[0].data[uvteller].uv = tc4
-            uvteller = uvteller + 1
-
-    # remove verts lacking xyz data
-    bpy.ops.object.mode_set(mode='EDIT')
-    mesh_ob = bpy.context.object
-    me = mesh_ob.data
-    bm = bmesh.from_edit_mesh(me)
-
-    verts = [v for v in bm.verts if v.co[0] == 0.0 and v.co[1] == 0.0 and v.co[2] == 0.0]
-    bmesh.ops.delete(bm, geom=verts, context="VERTS")
-    bmesh.update_edit_mesh(me)
-
-    # remove redundant verts
-    bpy.ops.object.mode_set(mode='EDIT')
-    mesh_ob = bpy.context.object
-    me = mesh_ob.data
-    bm = bmesh.from_edit_mesh(me)
-
-    verts = [v for v in bm.verts if len(v.link_faces) == 0]
-    bmesh.ops.delete(bm, geom=verts, context="VERTS")
-    bmesh.update_edit_mesh(me)
-
-    bpy.ops.object.editmode_toggle()
-
-    bpy.ops.object.origin_set(type='ORIGIN_GEOMETRY')
-    bpy.ops.object.mode_set(mode='OBJECT')
+    return None
+
+
+def remove_unused_material(material):
+    # Remove a material no mesh uses any more, with the textures (full size and proxy) only it used
+    if material is None or material.users > 0:
+        return
+
+    images = set()
+    if material.node_tree is not None:
+        images.update(node.image for node in material.node_tree.nodes
+                      if node.type == 'TEX_IMAGE' and node.image is not None)
+    for key in ('navcam_full', 'navcam_proxy'):
+        img = bpy.data.images.get(material.get(key, ''))
+        if img is not None:
+            images.add(img)
+
+    bpy.data.materials.remove(material)
+    for img in images:
+        if img.users == 0:
+            bpy.data.images.remove(img)
+
+
+def udim_offset(tile):
+    # uv offset of the tile-th texture of a UDIM set: ten tiles per row, starting at 1001
+    return (float(tile % 10), float(tile // 10))
+
+
+def load_udim_material(name, texture_filenames, curve, data_dir, pack='NOW', shading=False):
+    # Copy the textures into one UDIM tile set (name-<hash>.1001, name-<hash>.1002, ...) and return
+    # a single material using it, or None when the tiles cannot be shared (Blender before 2.82, or
+    # textures of different formats), in which case every product keeps its own material.
+    # The hash covers the source textures, so a different image set of the same site never
+    # overwrites tiles earlier materials use, and the same set reuses its tiles.
+    ext = os.path.splitext(texture_filenames[0])[1]
+    if bpy.app.version < (2, 82, 0) or any(os.path.splitext(fn)[1] != ext for fn in texture_filenames):
+        print('Cannot combine the textures of %s into UDIM tiles, using one material per image' %(name))
+        return None
+
+    tile_dir = os.path.join(data_dir, 'udim')
+    os.makedirs(tile_dir, exist_ok=True)
+
+    sources = [(os.path.abspath(fn), os.path.getsize(fn), int(os.path.getmtime(fn))) for fn in texture_filenames]
+    tile_set = '%s-%08x' %(name, zlib.crc32(repr(sources).encode('utf-8')))
+
+    tile_filenames = []
+    for tile, fn in enumerate(texture_filenames):
+        tile_filenames.append(os.path.join(tile_dir, '%s.%d%s' %(tile_set, 1001 + tile, ext)))
+        if not os.path.isfile(tile_filenames[-1]):
+            shutil.copyfile(fn, tile_filenames[-1])
+
+    img = bpy.data.images.load(tile_filenames[0], check_existing=True)
+    if img.source != 'TILED':
+        img.source = 'TILED'
+        for tile in range(1, len(tile_filenames)):
+            img.tiles.new(tile_number=1001 + tile)
+        img.reload()
+    mark_navcam_image(img, pack, 1.0)
+
+    engine = bpy.context.scene.render.engine
+    if engine in {'CYCLES', 'BLENDER_EEVEE', 'BLENDER_OPENGL'}:
+        return create_cycles_material(bpy.context, img, curve, shading)
+    return None
+
+
+def create_mesh_from_depthimage(rover, sol, image_depth_filename, image_texture_filename, do_fill, memory_limit=DEFAULT_MEMORY_LIMIT, curve=(0.0, 1.0)):
+    # Decode and mesh one local product outside of an import job, for scripts; the importer itself
+    # goes through fetch_depth() and build_depth_mesh(). curve: value range of a RAD texture, as
+    # for load_texture_material().
+    # snippets used from:
+    # https://svn.blender.org/svnroot/bf-extensions/contrib/py/scripts/addons/io_import_LRO_Lola_MGS_Mola_img.py
+    # https://arsf-dan.nerc.ac.uk/trac/attachment/wiki/Processing/SyntheticDataset/data_handler.py
+
+    if image_depth_filename == '':
+        return
+
+    depth = load_depth_product(image_depth_filename, do_fill, memory_limit)
+    if depth is None:
+        return
+
+    return build_depth_mesh(rover, sol, depth, image_texture_filename, curve)
+
+
+def build_depth_mesh(rover, sol, depth, image_texture_filename, curve=(0.0, 1.0), material=None, uv_offset=(0.0, 0.0),
+                     target=None):
+    # target: object of an earlier import of the product, its mesh is replaced in place and the
+    # camera and caption it already has are kept. The name of the camera is kept in the
+    # navcam_camera property of the object, see product_camera().
+    label = depth['label']
+    Faces = depth['faces']
+
+    TARGET_NAME = '%s-%s' %(sol, depth['name'])
+    verts, center = center_on_origin(depth['verts'])
+    mesh = mesh_from_arrays(TARGET_NAME, verts, Faces)
+
+    print('Texturing mesh...')
+
+    if target is None:
+        TARGET_NAME = mesh.name
+        ob_new = bpy.data.objects.new(TARGET_NAME, mesh)
+
+        theSolCollection = get_collection('Sol%s' %(sol))
+        theSolCollection.objects.link(ob_new)
+    else:
+        ob_new = target
+        old_mesh = ob_new.data
+        old_materials = list(old_mesh.materials)
+        ob_new.data = mesh
+        if old_mesh.users == 0:
+            # frees the name, so the new mesh keeps the name of the product
+            bpy.data.meshes.remove(old_mesh)
+            mesh.name = TARGET_NAME
+        print('Updated mesh of ', ob_new.name)
+
+    ob_new.location = center
+    ob_new.select_set(state=True)
+    bpy.context.view_layer.objects.active = ob_new
+
+    if material is None:
+        material = load_texture_material(image_texture_filename, curve)
+    if material is not None:
+        # add material to object
+        mesh.materials.append(material)
+        #me.show_double_sided = True
+
+        # per face corner, in the same order as the loops
+        uv = grid_uvs(depth['grid_index'], label['LINES'], label['LINE_SAMPLES'], depth.get('crop')) + np.asarray(uv_offset, dtype=np.float32)
+        mesh.uv_layers.new(name='UVMap').data.foreach_set('uv', uv[Faces].ravel())
+
+    if target is not None:
+        # the material of the replaced mesh, unless it is kept or still used elsewhere
+        for old_material in old_materials:
+            if old_material is not material:
+                remove_unused_material(old_material)
+
+    if depth.get('shading'):
+        for name, values in depth['shading'].items():
+            set_color_attribute(mesh, name, shading_colors(values), Faces)
+
+    if depth.get('normals') is not None:
+        set_custom_normals(mesh, depth['normals'])
 
     #mesh generation is done here, adding camera and text follows
 
+    if target is None:
+        cam_ob = add_camera_and_caption(rover, sol, depth, image_texture_filename, theSolCollection, product_center(depth))
+        ob_new['navcam_camera'] = cam_ob.name
+
+    print ('Mesh generation complete. Note: you must turn on rendering or preview to see texture.')
+
+    return ob_new
+
+
+def add_camera_and_caption(rover, sol, depth, image_texture_filename, theSolCollection, center):
+    creation_date = depth['label']['START_TIME']
+
     cam = bpy.data.cameras.new('Camera')
     cam.lens = 40
     cam.clip_start = 0.01
-    cam_ob = bpy.data.objects.new('Cam-' + os.path.basename(FileAndExt[0]), cam)
+    cam_ob = bpy.data.objects.new('Cam-' + depth['name'], cam)
 
-    bRoverVec = bRoverVec * 0.1
+    bRoverVec = depth['rover_vec'] * 0.1
 
     mat_loc = mathutils.Matrix.Translation(bRoverVec)
     mat_trans = mathutils.Matrix.Translation((0.0, 0.0, 0.15))
@@ -1151,18 +2913,15 @@ def create_mesh_from_depthimage(rover, sol, image_depth_filename, image_texture_
 
     tagtext = trover[rover-1] + ' ' + whichcam +' Navcam Image at Sol ' + str(sol) + '\n' + str(date_object.strftime('%d %b %Y %H:%M:%S')) + ' UTC\nNASA / JPL-CALTECH / phaseIV'
 
-    bpy.ops.object.text_add(enter_editmode=True, location = (-0.02, -0.0185, -0.05)) #location = (-0.018, -0.0185, -0.05))
-    bpy.ops.font.delete(type='PREVIOUS_WORD')
-    bpy.ops.font.text_insert(text=str(tagtext))
-    bpy.ops.object.editmode_toggle()
+    text_curve = bpy.data.curves.new('Text', type='FONT')
+    text_curve.body = tagtext
+    text_ob = bpy.data.objects.new('Text', text_curve)
+    text_ob.location = (-0.02, -0.0185, -0.05) #location = (-0.018, -0.0185, -0.05))
 
     textSize = 0.001
-    text_ob = bpy.context.view_layer.objects.active
     text_ob.scale = [textSize, textSize, textSize]
 
-    tempColl = find_collection(bpy.context, text_ob)
     theSolCollection.objects.link(text_ob)
-    tempColl.objects.unlink(text_ob)
 
     found = None
 
@@ -1176,18 +2935,270 @@ def create_mesh_from_depthimage(rover, sol, image_depth_filename, image_texture_
     text_ob.data.materials.append(mat)
     text_ob.parent = cam_ob
 
-    objloc = Vector(mesh_ob.location)
     rovloc = Vector(bRoverVec)
-    distvec = rovloc - objloc
+    distvec = rovloc - center
 
-    expoint = obj.matrix_world.to_translation()+Vector((0.0, 0.0, -0.04-distvec.length*0.1))
+    expoint = center + Vector((0.0, 0.0, -0.04-distvec.length*0.1))
     look_at(cam_ob, expoint)
 
     theSolCollection.objects.link(cam_ob)
     bpy.context.scene.camera = cam_ob
     #bpy.context.scene.update()
 
-    print ('Mesh generation complete. Note: you must turn on rendering or preview to see texture.')
+    return cam_ob
+
+
+def sample_texture_intensity(image_texture_filename, grid_index, LINES, LINE_SAMPLES):
+    # texture value at the grid position of every point, in the stored (sRGB) encoding of the
+    # texture whatever its format, see read_texture_gray()
+    gray, is_float = read_texture_gray(image_texture_filename)
+    height, width = gray.shape
+
+    x = (grid_index % LINE_SAMPLES) * width // LINE_SAMPLES
+    y = (grid_index // LINE_SAMPLES) * height // LINES
+    return gray[y, x].astype(np.float32)
+
+
+def point_attributes(product, depth, image_texture_filename):
+    label = depth['label']
+    return {'intensity': sample_texture_intensity(image_texture_filename, depth['grid_index'], label['LINES'], label['LINE_SAMPLES']),
+            'range': depth['range'],
+            'image_index': np.full(len(depth['verts']), product.index, dtype=np.int32)}
+
+
+def set_point_attribute(mesh, name, values):
+    # generic attributes since Blender 2.91, float/int vertex layers before
+    if values.dtype.kind == 'i':
+        if hasattr(mesh, 'attributes'):
+            layer = mesh.attributes.new(name, 'INT', 'POINT')
+        else:
+            layer = mesh.vertex_layers_int.new(name=name)
+    else:
+        if hasattr(mesh, 'attributes'):
+            layer = mesh.attributes.new(name, 'FLOAT', 'POINT')
+        else:
+            layer = mesh.vertex_layers_float.new(name=name)
+    layer.data.foreach_set('value', values)
+
+
+def build_point_cloud(name, collection, entries):
+    # One vertex-only mesh object from the (depth, point attributes) of one or more products.
+    # No faces, UVs, material or caption are created.
+    verts, center = center_on_origin(np.concatenate([depth['verts'] for depth, attributes in entries]))
+    mesh = mesh_from_arrays(name, verts, np.zeros((0, 4), dtype=np.int32))
+
+    for key in entries[0][1]:
+        set_point_attribute(mesh, key, np.concatenate([attributes[key] for depth, attributes in entries]))
+
+    ob_new = bpy.data.objects.new(mesh.name, mesh)
+    ob_new.location = center
+    collection.objects.link(ob_new)
+
+    print('Point cloud %s: %d points' %(mesh.name, len(verts)))
+    return ob_new
+
+
+def rasterize_dem(verts, values, cell, reduce, memory_limit=DEFAULT_MEMORY_LIMIT):
+    # Bin points into a top-down grid with cells of the given size (Blender units). Returns the
+    # (rows, columns, 3) grid of cell centers at the max or mean height of their points, zero for
+    # empty cells, and the mean of values per cell. The cell size grows when the grid would not
+    # fit in memory_limit. Without points the grid has no cells.
+    if len(verts) == 0:
+        return np.zeros((0, 0, 3), dtype=np.float32), np.zeros(0, dtype=np.float32)
+
+    lo = verts[:, :2].min(axis=0)
+    extent = verts[:, :2].max(axis=0) - lo
+
+    fit = math.sqrt(decode_memory(int(extent[1] / cell) + 1, int(extent[0] / cell) + 1) / (memory_limit * 1024.0 * 1024.0))
+    if fit > 1:
+        print('DEM cell size raised from %.3f to %.3f m to fit the memory limit' %(cell * 10, cell * fit * 10))
+        cell = cell * fit
+    columns, rows = (extent / cell).astype(np.int64) + 1
+
+    ix = np.minimum(((verts[:, 0] - lo[0]) / cell).astype(np.int64), columns - 1)
+    iy = np.minimum(((verts[:, 1] - lo[1]) / cell).astype(np.int64), rows - 1)
+    cell_id = iy * columns + ix
+
+    order = np.argsort(cell_id, kind='stable')
+    cell_id = cell_id[order]
+    starts = np.flatnonzero(np.r_[True, cell_id[1:] != cell_id[:-1]])
+    counts = np.diff(np.r_[starts, len(cell_id)])
+    cells = cell_id[starts]
+
+    z = verts[order, 2]
+    if reduce == 'MAX':
+        height = np.maximum.reduceat(z, starts)
+    else:
+        height = np.add.reduceat(z, starts) / counts
+
+    grid = np.zeros((rows, columns, 3), dtype=np.float32)
+    grid[cells // columns, cells % columns] = np.stack((lo[0] + (cells % columns + 0.5) * cell,
+                                                       lo[1] + (cells // columns + 0.5) * cell,
+                                                       height), axis=-1)
+
+    cell_values = np.zeros(rows * columns, dtype=np.float32)
+    cell_values[cells] = np.add.reduceat(values[order], starts) / counts
+
+    return grid, cell_values
+
+
+def build_dem(name, collection, entries, job):
+    # One height grid mesh from the (depth, point attributes) of one or more products, with the
+    # mean texture intensity of every cell as attribute. Products without any xyz point (holes,
+    # Max Range) give an empty mesh.
+    verts = np.concatenate([depth['verts'] for depth, attributes in entries])
+    intensity = np.concatenate([attributes['intensity'] for depth, attributes in entries])
+
+    grid, intensity = rasterize_dem(verts, intensity, job.dem_cell * 0.1, job.dem_reduce, job.memory_limit)
+    rows, columns = grid.shape[:2]
+    if rows == 0:
+        verts, faces, grid_index = grid.reshape(0, 3), np.zeros((0, 4), dtype=np.int32), np.zeros(0, dtype=np.int64)
+    else:
+        verts, faces, grid_index = build_grid_faces(grid, block_rows_for_limit(rows, columns, job.memory_limit))
+    del grid
+
+    verts, center = center_on_origin(verts)
+    mesh = mesh_from_arrays(name, verts, faces)
+    set_point_attribute(mesh, 'intensity', intensity[grid_index])
+
+    ob_new = bpy.data.objects.new(mesh.name, mesh)
+    ob_new.location = center
+    collection.objects.link(ob_new)
+
+    print('DEM %s: %d x %d cells, %d faces' %(mesh.name, columns, rows, len(faces)))
+    return ob_new
+
+
+def product_site(rover, sol, label):
+    # site index from the rover coordinate system, products without one are grouped per sol
+    if label['SITE'] is not None:
+        return 'Site%d' %(label['SITE'])
+    return 'Sol%s' %(sol)
+
+
+def weld_vertices(verts, faces, weld_distance, groups=None):
+    # Spatial hash weld: vertices falling in the same cell of a grid with weld_distance spacing
+    # collapse to their mean position. Faces that degenerate or end up duplicated are dropped.
+    # groups: product index per vertex. Vertices of one product are never welded to each other,
+    # near-field samples can be closer than weld_distance; the n-th vertex of a product in a
+    # cell is welded to the n-th vertex of every other product in that cell.
+    # Returns the welded vertices, remapped faces and the indices of the faces that were kept.
+    if len(verts) == 0:
+        return verts, faces, np.arange(len(faces))
+
+    cells = np.floor(verts / weld_distance).astype(np.int64)
+    cells -= cells.min(axis=0)
+
+    # pack the three cell coordinates in a single 64 bit key (21 bits each)
+    if cells.max() >= (1 << 21):
+        print('Mosaic extent too large for weld distance %s, keys may collide' %(weld_distance))
+    key = (cells[:, 0] << 42) | (cells[:, 1] << 21) | cells[:, 2]
+
+    if groups is None:
+        key, inverse = np.unique(key, return_inverse=True)
+    else:
+        # rank of every vertex among the vertices of its product in its cell
+        order = np.lexsort((groups, key))
+        run_start = np.ones(len(order), dtype=bool)
+        run_start[1:] = (key[order][1:] != key[order][:-1]) | (groups[order][1:] != groups[order][:-1])
+        starts = np.nonzero(run_start)[0]
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - starts[np.cumsum(run_start) - 1]
+        key, inverse = np.unique(np.stack([key, rank], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    counts = np.bincount(inverse)
+
+    welded = np.empty((len(key), 3), dtype=np.float32)
+    for axis in range(0, 3):
+        welded[:, axis] = np.bincount(inverse, weights=verts[:, axis]) / counts
+
+    faces = inverse[faces].astype(np.int32)
+
+    # drop faces with collapsed corners
+    srt = np.sort(faces, axis=1)
+    keep = np.all(srt[:, 1:] != srt[:, :-1], axis=1)
+
+    # drop faces that overlapping products contribute twice
+    _, first = np.unique(srt[keep], axis=0, return_index=True)
+    kept = np.nonzero(keep)[0][np.sort(first)]
+
+    return welded, faces[kept], kept
+
+
+def create_site_mosaic(rover, site, entries, weld_distance):
+    # entries hold (sol, depth, material, uv offset) for every product of the site; products
+    # sharing a material share its slot
+    print('Merging %d products into %s mosaic...' %(len(entries), site))
+
+    verts = []
+    faces = []
+    uvs = []
+    material_index = []
+    materials = []
+    shading = {}
+    normals = []
+    groups = []
+    base = 0
+
+    for sol, depth, material, uv_offset in entries:
+        if material not in materials:
+            materials.append(material)
+        index = materials.index(material)
+
+        label = depth['label']
+        uv = grid_uvs(depth['grid_index'], label['LINES'], label['LINE_SAMPLES'], depth.get('crop')) + np.asarray(uv_offset, dtype=np.float32)
+
+        verts.append(depth['verts'])
+        groups.append(np.full(len(depth['verts']), len(groups), dtype=np.int64))
+        faces.append(depth['faces'] + base)
+        uvs.append(uv[depth['faces']].reshape(-1, 2))
+        if depth.get('shading'):
+            for name, values in depth['shading'].items():
+                shading.setdefault(name, []).append(shading_colors(values)[depth['faces']].reshape(-1, 4))
+        if depth.get('normals') is not None:
+            normals.append(depth['normals'][depth['faces']].reshape(-1, 3))
+        material_index.append(np.full(len(depth['faces']), index, dtype=np.int32))
+        base = base + len(depth['verts'])
+
+    verts = np.concatenate(verts)
+    groups = np.concatenate(groups)
+    faces = np.concatenate(faces)
+    uvs = np.concatenate(uvs).reshape(len(faces), -1, 2)
+    shading = {name: np.concatenate(colors).reshape(len(faces), -1, 4)
+               for name, colors in shading.items() if len(colors) == len(entries)}
+    # per face corner, vertices of different products with different normals get welded
+    normals = np.concatenate(normals).reshape(len(faces), -1, 3) if len(normals) == len(entries) else None
+    material_index = np.concatenate(material_index)
+
+    vertex_count = len(verts)
+    verts, faces, kept = weld_vertices(verts, faces, weld_distance, groups)
+    print('Welded %d vertices into %d' %(vertex_count, len(verts)))
+
+    trover = [ 'Spirit', 'Opportunity', 'Curiosity' ]
+    verts, center = center_on_origin(verts)
+    mesh = mesh_from_arrays('%s-%s' %(trover[rover-1], site), verts, faces)
+
+    ob_new = bpy.data.objects.new(mesh.name, mesh)
+    ob_new.location = center
+    theSiteCollection = get_collection(site)
+    theSiteCollection.objects.link(ob_new)
+    ob_new.select_set(state=True)
+    bpy.context.view_layer.objects.active = ob_new
+
+    for material in materials:
+        mesh.materials.append(material)
+
+    mesh.polygons.foreach_set('material_index', material_index[kept])
+
+    mesh.uv_layers.new(name='UVMap').data.foreach_set('uv', uvs[kept].ravel())
+
+    for name, colors in shading.items():
+        set_color_attribute(mesh, name, colors[kept])
+
+    if normals is not None:
+        set_custom_normals(mesh, normals[kept])
+
+    return ob_new
 
 
 def look_at(obj_camera, point):
@@ -1199,24 +3210,22 @@ def look_at(obj_camera, point):
     obj_camera.rotation_euler = rot_quat.to_euler()
 
 
-def draw(self, context):
-    global popup_error
+ERROR_MESSAGES = {
+    1: "Unable to retrieve NAVCAM texture image.",
+    2: "Unable to retrieve NAVCAM depth image.",
+    3: "Navcam imagename has incorrect length (should be 27 for MER,  36 for MSL).",
+    4: "Not a valid Left Navcam imagename: should begin by 1N or 2N for MER, by N for MSL.",
+}
 
-    if(popup_error == 1):
-        self.layout.label(text="Unable to retrieve NAVCAM texture image.")
-        print("Unable to retrieve NAVCAM texture image.")
 
-    if(popup_error == 2):
-        self.layout.label(text="Unable to retrieve NAVCAM depth image.")
-        print("Unable to retrieve NAVCAM depth image.")
+def show_error(code, title):
+    message = ERROR_MESSAGES[code]
+    print(message)
 
-    if(popup_error == 3):
-        self.layout.label(text="Navcam imagename has incorrect length (should be 27 for MER,  36 for MSL).")
-        print("Navcam imagename has incorrect length (should be 27 for MER,  36 for MSL).")
+    def draw(self, context):
+        self.layout.label(text=message)
 
-    if(popup_error == 4):
-        self.layout.label(text="Not a valid Left Navcam imagename: should begin by 1N or 2N for MER, by N for MSL.")
-        print("Not a valid Left Navcam imagename: should begin by 1N or 2N for MER, by N for MSL.")
+    bpy.context.window_manager.popup_menu(draw, title = title, icon = 'ERROR')
 
 
 class NavcamToolsPanel(bpy.types.Panel):
@@ -1236,12 +3245,20 @@ def register():
     bpy.utils.register_class(NavcamDialogOperator)
     bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
     bpy.utils.register_class(NavcamToolsPanel)
+    bpy.app.handlers.save_pre.append(pack_navcam_images_on_save)
+    bpy.app.handlers.render_pre.append(use_full_textures)
+    bpy.app.handlers.render_post.append(use_proxy_textures)
+    bpy.app.handlers.render_cancel.append(use_proxy_textures)
 
 
 def unregister():
     bpy.utils.unregister_class(NavcamDialogOperator)
     bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
     bpy.utils.unregister_class(NavcamToolsPanel)
+    bpy.app.handlers.save_pre.remove(pack_navcam_images_on_save)
+    bpy.app.handlers.render_pre.remove(use_full_textures)
+    bpy.app.handlers.render_post.remove(use_proxy_textures)
+    bpy.app.handlers.render_cancel.remove(use_proxy_textures)
 
 def ShowMessageBox(message = "", title = "Message Box", icon = 'INFO'):
 